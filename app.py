@@ -1,20 +1,104 @@
 from flask import Flask
+from flask.cli import with_appcontext
+import logging
 import os
-from db.database import init_db
+import click
+from db.database import init_db, init_app, db_connect, db_close
 
-from routers.auth_routers import auth_bp
-from routers.main_routers import main_bp
-from routers.admin_routers import admin_bp
 
-app = Flask(__name__)
+def create_app(config=None):
+    """Фабрика приложения. Базу не трогает: схема и миграции
+    применяются отдельно командой `flask init-db`. Маршруты и сервисы
+    импортируются здесь, а не при импорте модуля: `import app` их не тянет."""
+    from db import maintenance
+    from services import assets, covers, fragments, images, jobs, metrics
+    from routers.auth_routers import auth_bp
+    from routers.main_routers import main_bp
+    from routers.admin_routers import admin_bp
+    from routers.api_routers import api_bp
 
-app.register_blueprint(auth_bp)
-app.register_blueprint(main_bp)
-app.register_blueprint(admin_bp)
+    # Отладочные сообщения (SQL, загрузка обложек) включаются через LOG_LEVEL=DEBUG
+    logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING'),
+                        format='%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+    if config:
+        app.config.update(config)
+
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(main_bp)
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(api_bp)
+
+    init_app(app)
+    assets.init_app(app)
+    images.init_app(app)
+    covers.init_app(app)
+    fragments.init_app(app)
+    jobs.init_app(app)
+    maintenance.init_app(app)
+    metrics.init_app(app)
+
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(check_indexes)
+    app.cli.add_command(backfill_covers)
+    app.cli.add_command(compress_static)
+    return app
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Создает таблицы, администратора и применяет миграции (один раз при развертывании)"""
+    init_db()
+    conn, cur = db_connect(readonly=True)
+    cur.execute("SELECT COUNT(*) FROM books_duplicates")
+    duplicates = cur.fetchone()[0]
+    db_close(conn, cur)
+    if duplicates:
+        print(f"Дубликаты книг (до уникального индекса) перенесены в таблицу books_duplicates: {duplicates}")
+    print("База данных готова")
+
+
+@click.command('check-indexes')
+@with_appcontext
+def check_indexes():
+    """Проверяет, что запросы каталога обслуживаются индексами"""
+    from db.migrations import check_query_plans
+    conn, cur = db_connect()
+    problems = check_query_plans(conn)
+    db_close(conn, cur)
+    for query, plan in problems:
+        print(f"Полное сканирование: {' '.join(query.split())}")
+        for step in plan:
+            print(f"    {step}")
+    if problems:
+        raise SystemExit(1)
+    print("Все запросы используют индексы")
+
+
+@click.command('backfill-covers')
+@with_appcontext
+def backfill_covers():
+    """Строит миниатюры (WebP/AVIF/JPEG) для уже загруженных обложек"""
+    from services import images
+    done = images.backfill(progress=lambda name, n: print(f"[{n}] {name}"))
+    print(f"Обработано обложек: {done}")
+
+
+@click.command('compress-static')
+@with_appcontext
+def compress_static():
+    """Заранее сжимает CSS/JS/иконки в static/ (.gz и .br, если есть brotli)"""
+    from flask import current_app
+    from services import assets
+    written = assets.precompress(
+        current_app.static_folder,
+        progress=lambda name, size, compressed: print(f"{name}: {size} -> {compressed} байт"))
+    print(f"Сжатых файлов: {written}")
 
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
 
 if __name__ == '__main__':
-    with app.app_context():
-        init_db()
-    app.run(debug=True)
+    # Только для разработки; в продакшене: gunicorn -c gunicorn.conf.py wsgi:app
+    create_app().run(debug=os.environ.get('FLASK_DEBUG') == '1')
@@ -0,0 +1,474 @@
+"""Нагрузочный бенчмарк каталога, админки и входа на синтетических данных.
+
+Для каждого размера каталога (10k, 1m, 10m) база строится один раз по схеме
+init_db и кэшируется в --data-dir. Сценарии гоняются через тестовый клиент
+Flask и/или настоящий WSGI-сервер (werkzeug, потоковый) в --clients потоков:
+
+    python bench/bench_catalog.py --sizes 10k,1m --transports client,wsgi \\
+        --clients 8 --duration 5 --output results.json
+
+Результаты (rps, p50/p90/p99/max, коды ответов) пишутся в JSON, чтобы
+сравнивать ревизии между собой. Каждый размер выполняется в отдельном
+процессе: путь к базе читается модулями при импорте.
+"""
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.bench_hashing import percentile  # noqa: E402
+
+DATA_DIR = os.path.join(ROOT, 'bench', 'data')
+PER_PAGE = 21
+
+SIZES = {'k': 1000, 'm': 1000 * 1000}
+
+
+def parse_size(value):
+    value = value.strip().lower()
+    if value[-1:] in SIZES:
+        return int(float(value[:-1]) * SIZES[value[-1]])
+    return int(value)
+
+
+# --- Синтетические данные ---------------------------------------------------
+
+def catalog_path(size, seed, data_dir):
+    return os.path.join(data_dir, f"catalog-{size}-{seed}.db")
+
+
+def build_catalog(size, seed, data_dir):
+    """Создает базу по схеме init_db и заливает в нее size синтетических книг"""
+    os.makedirs(data_dir, exist_ok=True)
+    path = catalog_path(size, seed, data_dir)
+    for suffix in ('', '-wal', '-shm', '.ready'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.environ['DATABASE_PATH'] = path
+
+    from db.database import init_db
+    from db.maintenance import connect, seed_books
+
+    init_db()
+    conn = connect(path)
+    started = time.perf_counter()
+
+    def progress(stats):
+        if stats['batches'] % 20 == 0:
+            print(f"  {stats['processed']:>10} книг, {time.perf_counter() - started:.0f}s", flush=True)
+
+    stats = seed_books(conn, size, seed, progress=progress)
+    conn.close()
+    print(f"  каталог {size}: {stats['processed']} книг за {time.perf_counter() - started:.1f}s", flush=True)
+    open(path + '.ready', 'w').close()
+
+
+def ensure_catalog(size, seed, data_dir):
+    """Путь к базе с size книгами; строит ее в отдельном процессе, если в кэше нет"""
+    path = catalog_path(size, seed, data_dir)
+    if not os.path.exists(path + '.ready'):
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--build', str(size),
+                        '--seed', str(seed), '--data-dir', data_dir], check=True)
+    return path
+
+
+def catalog_samples(path, depth):
+    """Значения для сценариев: частые/редкие авторы и издательства,
+    курсоры на глубине depth для каждого поля сортировки"""
+    from db.catalog import SORT_FIELDS, encode_cursor
+
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    facet = ("SELECT value FROM book_counts WHERE facet = ? AND value != '' "
+             "ORDER BY count {} LIMIT 1")
+    samples = {
+        'author_top': conn.execute(facet.format('DESC'), ('author',)).fetchone()[0],
+        'author_rare': conn.execute(facet.format('ASC'), ('author',)).fetchone()[0],
+        'publisher_top': conn.execute(facet.format('DESC'), ('publisher',)).fetchone()[0],
+        'cursors': {},
+    }
+    total = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+    offset = min(depth, max(total - 1, 0))
+    samples['page'] = offset // PER_PAGE + 1
+    for field in SORT_FIELDS:
+        row = conn.execute(f"SELECT id, {field} FROM books ORDER BY {field}, id LIMIT 1 OFFSET ?",
+                           (offset,)).fetchone()
+        if row:
+            samples['cursors'][field] = encode_cursor(row, field, 'asc')
+    conn.close()
+    return samples
+
+
+# --- Транспорт ----------------------------------------------------------------
+
+class TestClientTransport:
+    """Запросы в процессе через app.test_client() - без сети"""
+    name = 'client'
+
+    def __init__(self, app):
+        self.app = app
+
+    def client(self):
+        client = self.app.test_client()
+
+        def send(method, path, data=None):
+            response = client.open(path, method=method, data=data)
+            response.get_data()
+            return response.status_code
+        return send
+
+    def close(self):
+        pass
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class WsgiTransport:
+    """Настоящий HTTP: потоковый werkzeug-сервер в фоне, у каждого клиента свои cookies"""
+    name = 'wsgi'
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        # Журнал доступа на каждый запрос исказил бы замеры
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def client(self):
+        opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+        def send(method, path, data=None):
+            body = urllib.parse.urlencode(data).encode() if data is not None else None
+            request = urllib.request.Request(self.base + path, data=body, method=method)
+            try:
+                with opener.open(request, timeout=60) as response:
+                    response.read()
+                    return response.status
+            except urllib.error.HTTPError as e:
+                e.read()
+                return e.code
+        return send
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+TRANSPORTS = {'client': TestClientTransport, 'wsgi': WsgiTransport}
+
+
+# --- Нагрузка -------------------------------------------------------------------
+
+def summarize(latencies, statuses, errors, elapsed):
+    ms = [value * 1000 for value in latencies]
+    return {
+        'requests': len(latencies),
+        'rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(ms, 50), 2) if ms else None,
+        'p90_ms': round(percentile(ms, 90), 2) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 2) if ms else None,
+        'max_ms': round(max(ms), 2) if ms else None,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'errors': errors,
+    }
+
+
+def run_load(transport, action, clients, duration, setup=None):
+    """Запускает clients потоков, каждый вызывает action(send, rng) до дедлайна.
+    action возвращает код ответа; ошибкой считаются 5xx и исключения."""
+    latencies, statuses = [], {}
+    errors = [0]
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+    deadline = [None]
+
+    def worker(index):
+        send = transport.client()
+        if setup:
+            setup(send)
+        rng = random.Random(index)
+        local_latencies, local_statuses, local_errors = [], {}, 0
+        barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            start = time.perf_counter()
+            try:
+                status = action(send, rng)
+            except Exception:
+                local_errors += 1
+                continue
+            local_latencies.append(time.perf_counter() - start)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+            if status >= 500:
+                local_errors += 1
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            for code, count in local_statuses.items():
+                statuses[code] = statuses.get(code, 0) + count
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    deadline[0] = time.perf_counter() + duration
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, statuses, errors[0], time.perf_counter() - started)
+
+
+def get(path):
+    return lambda send, rng: send('GET', path)
+
+
+def read_scenarios(samples):
+    """Сценарии чтения: имя -> action(send, rng)"""
+    from db.catalog import SORT_FIELDS, SORT_ORDERS
+
+    quote = urllib.parse.quote
+    scenarios = {'index': get('/')}
+    for field in SORT_FIELDS:
+        for order in SORT_ORDERS:
+            scenarios[f"sort_{field}_{order}"] = get(f"/?sort_field={field}&sort_order={order}")
+    scenarios['deep_offset'] = get(f"/?page={samples['page']}")
+    for field, cursor in samples['cursors'].items():
+        scenarios[f"deep_cursor_{field}"] = get(f"/?sort_field={field}&sort_order=asc&after={cursor}")
+    scenarios.update({
+        'filter_author_top': get(f"/?author={quote(samples['author_top'])}"),
+        'filter_author_rare': get(f"/?author={quote(samples['author_rare'])}"),
+        'filter_publisher': get(f"/?publisher={quote(samples['publisher_top'])}"),
+        'filter_pages': get("/?pages_min=200&pages_max=400"),
+        'filter_author_pages': get(f"/?author={quote(samples['author_top'])}&pages_min=300"),
+        'filter_publisher_pages_sorted': get(
+            f"/?publisher={quote(samples['publisher_top'])}&pages_max=250&sort_field=pages&sort_order=desc"),
+        'search': get(f"/?q={quote('тайна')}"),
+        'search_author': get(f"/?q={quote('сад')}&author={quote(samples['author_top'])}"),
+        'api_books': get("/api/books?limit=100&fields=id,title,author"),
+        'api_books_deep': get(f"/api/books?limit=100&sort_field=title&after={samples['cursors'].get('title', '')}"),
+    })
+    # Случайная смесь всех сценариев - фон для записи
+    pool = list(scenarios.values())
+    scenarios['mixed'] = lambda send, rng: rng.choice(pool)(send, rng)
+    return scenarios
+
+
+def login_as(username, password):
+    def setup(send):
+        status = send('POST', '/login', {'username': username, 'password': password})
+        if status != 302:
+            raise RuntimeError(f"login {username} failed: {status}")
+    return setup
+
+
+def run_writes(transport, db_path, readers, duration, reader_action):
+    """Добавление/правка/удаление книг администратором на фоне readers читателей.
+    Задержки записи считаются по каждой операции отдельно."""
+    lookup = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+    ops = {'add': [], 'edit': [], 'delete': []}
+    statuses, errors = {}, [0]
+    stop, ready = threading.Event(), threading.Event()
+
+    def writer():
+        send = transport.client()
+        try:
+            login_as('admin', 'admin123')(send)
+        finally:
+            ready.set()
+        while not stop.is_set():
+            title = f"bench {uuid.uuid4().hex[:12]}"
+            form = {'title': title, 'author': 'Бенчмарк', 'pages': '123', 'publisher': 'Бенч'}
+            for op in ('add', 'edit', 'delete'):
+                start = time.perf_counter()
+                try:
+                    if op == 'add':
+                        status = send('POST', '/add_book', form)
+                        row = lookup.execute("SELECT id FROM books WHERE title = ?", (title,)).fetchone()
+                        if row is None:
+                            errors[0] += 1
+                            break
+                        book_id = row[0]
+                    elif op == 'edit':
+                        status = send('POST', f"/edit_book/{book_id}", dict(form, pages='321'))
+                    else:
+                        status = send('POST', f"/admin/delete_book/{book_id}")
+                except Exception:
+                    errors[0] += 1
+                    break
+                ops[op].append(time.perf_counter() - start)
+                statuses[status] = statuses.get(status, 0) + 1
+                if status >= 500:
+                    errors[0] += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    reads = run_load(transport, reader_action, readers, duration) if readers else None
+    if not readers:
+        time.sleep(duration)
+    stop.set()
+    thread.join()
+    elapsed = time.perf_counter() - started
+    lookup.close()
+    return {
+        'readers': reads,
+        'writes': {op: summarize(values, {}, 0, elapsed) for op, values in ops.items()},
+        'write_statuses': {str(code): count for code, count in sorted(statuses.items())},
+        'write_errors': errors[0],
+    }
+
+
+# --- Запуск -----------------------------------------------------------------------
+
+def run_size(size, args):
+    db_path = ensure_catalog(size, args.seed, args.data_dir)
+    # Каждый прогон пишет в свою копию: записи не должны накапливаться в кэше данных
+    work_dir = tempfile.mkdtemp(prefix='bench-catalog-')
+    work_path = os.path.join(work_dir, 'bench.db')
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(work_path)
+    source.backup(target)
+    source.close()
+    target.close()
+    os.environ['DATABASE_PATH'] = work_path
+
+    from app import create_app
+    from db.database import db_connect, db_close
+    from services import hashing, page_cache
+
+    app = create_app({'SECRET_KEY': 'bench'})
+    if not args.page_cache:
+        # max_bytes=0 - ничего не кладется в кэш, меряем сами запросы
+        page_cache._cache.max_bytes = 0
+    with app.app_context():
+        conn, cur = db_connect()
+        cur.execute("INSERT OR IGNORE INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
+                    ('bench', hashing.hash_password('bench-password'), False))
+        db_close(conn, cur)
+
+    samples = catalog_samples(work_path, args.depth if args.depth is not None else size // 2)
+    scenarios = read_scenarios(samples)
+    selected = [name for name in scenarios if not args.scenarios or name in args.scenarios]
+
+    result = {'size': size, 'page_cache': args.page_cache, 'clients': args.clients,
+              'duration': args.duration, 'deep_page': samples['page'], 'transports': {}}
+    for transport_name in args.transports:
+        transport = TRANSPORTS[transport_name](app)
+        runs = {}
+        try:
+            for name in selected:
+                run_load(transport, scenarios[name], 1, min(0.2, args.duration))  # прогрев
+                runs[name] = run_load(transport, scenarios[name], args.clients, args.duration)
+                report(size, transport_name, name, runs[name])
+            if not args.scenarios or 'login' in args.scenarios:
+                runs['login'] = run_load(transport, lambda send, rng: send(
+                    'POST', '/login', {'username': 'bench', 'password': 'bench-password'}),
+                    args.clients, args.duration)
+                report(size, transport_name, 'login', runs['login'])
+            if not args.scenarios or 'writes' in args.scenarios:
+                runs['writes'] = run_writes(transport, work_path, args.clients, args.duration,
+                                            scenarios['mixed'])
+                for op, stats in runs['writes']['writes'].items():
+                    report(size, transport_name, f"write_{op}", stats)
+                if runs['writes']['readers']:
+                    report(size, transport_name, 'reads_during_writes', runs['writes']['readers'])
+        finally:
+            transport.close()
+        result['transports'][transport_name] = runs
+    return result
+
+
+def report(size, transport, name, stats):
+    if not stats['requests']:
+        print(f"{size:>9} {transport:<6} {name:<32} нет запросов", flush=True)
+        return
+    print(f"{size:>9} {transport:<6} {name:<32} {stats['requests']:>7} req  "
+          f"{stats['rps']:>9} rps  p50={stats['p50_ms']}ms  p99={stats['p99_ms']}ms  "
+          f"err={stats['errors']}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10k', help='Размеры каталога через запятую: 10k,1m,10m')
+    parser.add_argument('--transports', default='client,wsgi', help='client, wsgi или оба')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=3.0, help='Секунд на сценарий')
+    parser.add_argument('--scenarios', default='', help='Только эти сценарии (через запятую)')
+    parser.add_argument('--depth', type=int, default=None, help='Смещение для глубокой пагинации (по умолчанию середина)')
+    parser.add_argument('--page-cache', action='store_true', help='Не отключать кэш страниц')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--data-dir', default=DATA_DIR, help='Где хранить сгенерированные базы')
+    parser.add_argument('--output', help='Куда записать результаты JSON')
+    parser.add_argument('--build', type=parse_size, help='Только сгенерировать каталог этого размера')
+    args = parser.parse_args()
+
+    if args.build:
+        build_catalog(args.build, args.seed, args.data_dir)
+        return
+
+    sizes = [parse_size(value) for value in args.sizes.split(',') if value.strip()]
+    args.transports = [name.strip() for name in args.transports.split(',') if name.strip()]
+    unknown = [name for name in args.transports if name not in TRANSPORTS]
+    if unknown:
+        parser.error(f"Неизвестный транспорт: {', '.join(unknown)}")
+    args.scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+
+    if len(sizes) == 1:
+        results = [run_size(sizes[0], args)]
+    else:
+        # Модули читают DATABASE_PATH при импорте - каждый размер в своем процессе
+        results = []
+        for size in sizes:
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+                out = tmp.name
+            argv = _replace_arg(_replace_arg(sys.argv[1:], '--sizes', str(size)), '--output', out)
+            subprocess.run([sys.executable, os.path.abspath(__file__)] + argv, check=True)
+            with open(out, encoding='utf-8') as f:
+                results.extend(json.load(f)['results'])
+            os.remove(out)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'argv': sys.argv[1:], 'python': sys.version.split()[0],
+                       'sqlite': sqlite3.sqlite_version, 'results': results},
+                      f, ensure_ascii=False, indent=2)
+
+
+def _replace_arg(argv, name, value):
+    result, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+        if arg == name:
+            skip = True
+            continue
+        if arg.startswith(name + '='):
+            continue
+        result.append(arg)
+    return result + [name, value]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Стресс-проверка разделения чтения и записи: читатели каталога на фоне
+непрерывных записей (по одной книге и пачками импорта).
+
+Для каждого режима чтения (wal, replica) и размера очереди писателей
+считает задержки и ошибки "database is locked" у читателей и писателей.
+Завершается с кодом 1, если у читателей были любые ошибки, а у кого-либо
+"database is locked":
+
+    python bench/bench_concurrency.py --readers 16 --writers 4 --duration 10
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.bench_hashing import percentile  # noqa: E402
+
+
+def _stats(latencies, errors, elapsed):
+    ms = [value * 1000 for value in latencies]
+    return {
+        'ops': len(latencies),
+        'ops_per_sec': round(len(latencies) / elapsed, 2),
+        'p50_ms': round(percentile(ms, 50), 2) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 2) if ms else None,
+        'max_ms': round(max(ms), 2) if ms else None,
+        'errors': errors,
+    }
+
+
+def run_round(readers, writers, bulk, duration):
+    from db.database import db_connect, db_close
+    from db.catalog import fetch_page, count_books, filters_from_args
+    from db.bulk import import_books
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    results = {'read': ([], {}), 'write': ([], {}), 'bulk': ([], {})}
+
+    def record(kind, latencies, errors):
+        with lock:
+            results[kind][0].extend(latencies)
+            for name, count in errors.items():
+                results[kind][1][name] = results[kind][1].get(name, 0) + count
+
+    def reader(index):
+        latencies, errors = [], {}
+        filters = filters_from_args({'pages_min': str(100 + index)})
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                conn, cur = db_connect(readonly=True)
+                fetch_page(cur, filters, 'title', 'asc', 21, page=1 + index % 5)
+                count_books(cur, filters)
+                db_close(conn, cur)
+            except sqlite3.Error as e:
+                errors[str(e)] = errors.get(str(e), 0) + 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        record('read', latencies, errors)
+
+    def writer():
+        latencies, errors = [], {}
+        while not stop.is_set():
+            title = f"stress {uuid.uuid4().hex[:12]}"
+            start = time.perf_counter()
+            try:
+                conn, cur = db_connect()
+                cur.execute("SELECT id FROM books WHERE title = ? AND author = ? AND publisher = ?",
+                            (title, 'Стресс', 'Стресс'))
+                cur.execute("INSERT INTO books (title, author, pages, publisher) VALUES (?, ?, ?, ?)",
+                            (title, 'Стресс', 100, 'Стресс'))
+                book_id = cur.lastrowid
+                cur.execute("UPDATE books SET pages = 200 WHERE id = ?", (book_id,))
+                cur.execute("DELETE FROM books WHERE id = ?", (book_id,))
+                db_close(conn, cur)
+            except sqlite3.Error as e:
+                errors[str(e)] = errors.get(str(e), 0) + 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        record('write', latencies, errors)
+
+    def bulk_writer():
+        latencies, errors = [], {}
+        while not stop.is_set():
+            rows = ({'title': f"bulk {uuid.uuid4().hex}", 'author': 'Импорт', 'pages': 50 + i,
+                     'publisher': 'Импорт'} for i in range(2000))
+            start = time.perf_counter()
+            try:
+                conn, cur = db_connect()
+                import_books(conn, rows, batch_size=1000)
+                db_close(conn, cur)
+            except sqlite3.Error as e:
+                errors[str(e)] = errors.get(str(e), 0) + 1
+                continue
+            latencies.append(time.perf_counter() - start)
+        record('bulk', latencies, errors)
+
+    threads = ([threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+               + [threading.Thread(target=writer) for _ in range(writers)]
+               + [threading.Thread(target=bulk_writer) for _ in range(bulk)])
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return {kind: _stats(latencies, errors, elapsed) for kind, (latencies, errors) in results.items()}
+
+
+def problems(result):
+    """Ошибки раунда, которых при разделении чтения и записи быть не должно"""
+    found = [f"read: {error} x{count}" for error, count in result['read']['errors'].items()]
+    for kind in ('write', 'bulk'):
+        found.extend(f"{kind}: {error} x{count}" for error, count in result[kind]['errors'].items()
+                     if 'database is locked' in error)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='wal,replica')
+    parser.add_argument('--writer-queues', default='1,0', help='DB_WRITERS для прогонов (0 - без очереди)')
+    parser.add_argument('--readers', type=int, default=16)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--bulk', type=int, default=1, help='Потоков массового импорта')
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--output', help='Куда записать результаты JSON')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-concurrency-')
+    os.environ['DATABASE_PATH'] = os.path.join(tmp_dir, 'bench.db')
+
+    from db.database import init_db, configure
+
+    init_db()
+    results = {'readers': args.readers, 'writers': args.writers, 'bulk': args.bulk,
+               'duration': args.duration, 'rounds': []}
+    for mode in args.modes.split(','):
+        for queue_size in [int(x) for x in args.writer_queues.split(',')]:
+            configure(read_mode=mode, writers=queue_size)
+            result = run_round(args.readers, args.writers, args.bulk, args.duration)
+            result.update(mode=mode, writer_queue=queue_size)
+            results['rounds'].append(result)
+            for kind in ('read', 'write', 'bulk'):
+                stats = result[kind]
+                print(f"{mode:<8} queue={queue_size}  {kind:<5} {stats['ops_per_sec']:>9} ops/s  "
+                      f"p50={stats['p50_ms']}ms  p99={stats['p99_ms']}ms  max={stats['max_ms']}ms  "
+                      f"errors={sum(stats['errors'].values())} {stats['errors'] or ''}", flush=True)
+            result['problems'] = problems(result)
+    configure()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    failed = [(result['mode'], result['writer_queue'], problem)
+              for result in results['rounds'] for problem in result['problems']]
+    for mode, queue_size, problem in failed:
+        print(f"FAIL {mode} queue={queue_size}: {problem}", file=sys.stderr)
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
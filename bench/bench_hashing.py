@@ -0,0 +1,105 @@
+"""Бенчмарк входа: пропускная способность и p99 задержки /login
+при разных размерах пула хэширования.
+
+    python bench/bench_hashing.py --pool-sizes 1,2,4 --clients 16 --duration 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run_round(app, clients, duration):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        client = app.test_client()
+        local_latencies, local_statuses = [], {}
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = client.post('/login', data={'username': 'bench', 'password': 'bench-password'})
+            local_latencies.append(time.perf_counter() - start)
+            local_statuses[response.status_code] = local_statuses.get(response.status_code, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for code, count in local_statuses.items():
+                statuses[code] = statuses.get(code, 0) + count
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ok = statuses.get(302, 0)
+    return {
+        'requests': len(latencies),
+        'logins_per_sec': round(ok / elapsed, 2),
+        'rejected_503': statuses.get(503, 0),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'statuses': statuses,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pool-sizes', default='0,1,2,4')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--queue-size', type=int, default=None)
+    parser.add_argument('--output', help='Куда записать результаты JSON')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-hashing-')
+    os.environ['DATABASE_PATH'] = os.path.join(tmp_dir, 'bench.db')
+
+    from app import create_app
+    from db.database import init_db, db_connect, db_close
+    from services import hashing
+
+    app = create_app({'SECRET_KEY': 'bench'})
+    with app.app_context():
+        init_db()
+        conn, cur = db_connect()
+        cur.execute("INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
+                    ('bench', hashing.hash_password('bench-password'), False))
+        db_close(conn, cur)
+
+    results = {'method': hashing.PASSWORD_HASH_METHOD, 'clients': args.clients,
+               'duration': args.duration, 'rounds': []}
+    for size in [int(x) for x in args.pool_sizes.split(',')]:
+        hashing.configure(workers=size, queue_size=args.queue_size if args.queue_size is not None else size * 4)
+        run_round(app, 1, 0.2)  # прогрев пула
+        result = run_round(app, args.clients, args.duration)
+        result['pool_size'] = size
+        results['rounds'].append(result)
+        print(f"pool={size:>2}  {result['logins_per_sec']:>8} logins/s  "
+              f"p50={result['p50_ms']}ms  p99={result['p99_ms']}ms  503={result['rejected_503']}")
+    hashing.configure()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
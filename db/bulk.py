@@ -0,0 +1,154 @@
+import csv
+import io
+import json
+from db.migrations import fold_sql
+
+# Поля книги в файлах импорта/экспорта
+BOOK_FIELDS = ('title', 'author', 'pages', 'publisher', 'cover_image')
+FORMATS = ('csv', 'jsonl')
+
+BATCH_SIZE = 5000
+EXPORT_FETCH_SIZE = 1000
+
+# Дубликат определяется уникальным индексом (title, author, publisher).
+# Строка обновляется, только если что-то действительно изменилось,
+# чтобы не дергать триггеры поиска и счетчиков впустую.
+UPSERT_SQL = """
+    INSERT INTO books (title, author, pages, publisher, cover_image)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (title, author, publisher) DO UPDATE SET
+        pages = excluded.pages,
+        cover_image = excluded.cover_image
+    WHERE pages != excluded.pages OR cover_image != excluded.cover_image
+"""
+
+
+# Обслуживание производных данных для новых строк пачки одним запросом
+# вместо построчных триггеров (они выключены флагом bulk_load)
+BULK_MAINTENANCE_SQL = [
+    f"""INSERT INTO books_fts (rowid, title, author, publisher)
+        SELECT id, {fold_sql('title')}, {fold_sql('author')}, {fold_sql('publisher')}
+        FROM books WHERE id > :last_id""",
+    """INSERT INTO book_counts (facet, value, count)
+       SELECT 'total', '', COUNT(*) FROM books WHERE id > :last_id
+       ON CONFLICT (facet, value) DO UPDATE SET count = count + excluded.count""",
+    """INSERT INTO book_counts (facet, value, count)
+       SELECT 'author', author, COUNT(*) FROM books WHERE id > :last_id GROUP BY author
+       ON CONFLICT (facet, value) DO UPDATE SET count = count + excluded.count""",
+    """INSERT INTO book_counts (facet, value, count)
+       SELECT 'publisher', publisher, COUNT(*) FROM books WHERE id > :last_id GROUP BY publisher
+       ON CONFLICT (facet, value) DO UPDATE SET count = count + excluded.count""",
+    """INSERT INTO cover_refs (name, refs)
+       SELECT cover_image, COUNT(*) FROM books WHERE id > :last_id AND cover_image IS NOT NULL
+       GROUP BY cover_image
+       ON CONFLICT (name) DO UPDATE SET refs = refs + excluded.refs""",
+    "UPDATE catalog_meta SET value = value + 1 WHERE key = 'generation'",
+]
+
+
+def read_rows(stream, fmt):
+    """Построчно читает словари книг из бинарного потока CSV или JSONL"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        yield from csv.DictReader(text)
+    elif fmt == 'jsonl':
+        for line in text:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+    else:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+
+
+def _clean(row):
+    """Кортеж для UPSERT_SQL или None, если строка некорректна"""
+    if not isinstance(row, dict):
+        return None
+    title = str(row.get('title') or '').strip()
+    author = str(row.get('author') or '').strip()
+    publisher = str(row.get('publisher') or '').strip()
+    cover_image = str(row.get('cover_image') or '').strip() or 'default_cover.jpg'
+    try:
+        pages = int(row.get('pages'))
+    except (TypeError, ValueError):
+        return None
+    if not all([title, author, publisher]) or pages <= 0:
+        return None
+    return title, author, pages, publisher, cover_image
+
+
+def import_books(conn, rows, batch_size=BATCH_SIZE, progress=None):
+    """Загружает книги пачками executemany, по транзакции на пачку.
+    Память не зависит от размера файла. Возвращает статистику."""
+    stats = {'processed': 0, 'skipped': 0, 'batches': 0}
+    batch = []
+
+    def flush():
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Обновления через UPSERT не меняют (title, author, publisher),
+            # поэтому индекс поиска и счетчики нужно дополнить только новыми строками
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM books").fetchone()[0]
+            conn.execute("UPDATE catalog_meta SET value = 1 WHERE key = 'bulk_load'")
+            conn.executemany(UPSERT_SQL, batch)
+            for statement in BULK_MAINTENANCE_SQL:
+                conn.execute(statement, {'last_id': last_id})
+            conn.execute("UPDATE catalog_meta SET value = 0 WHERE key = 'bulk_load'")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        stats['processed'] += len(batch)
+        stats['batches'] += 1
+        batch.clear()
+        if progress:
+            progress(stats)
+
+    conn.commit()
+    for row in rows:
+        values = _clean(row)
+        if values is None:
+            stats['skipped'] += 1
+            continue
+        batch.append(values)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return stats
+
+
+def export_books(conn, fmt):
+    """Генератор текстовых кусков CSV/JSONL по всей таблице books.
+    Строки читаются курсором порциями, а не fetchall()."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    cur = conn.cursor()
+    cur.execute(f"SELECT {', '.join(BOOK_FIELDS)} FROM books ORDER BY id")
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(BOOK_FIELDS)
+
+    try:
+        while True:
+            rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                if writer:
+                    writer.writerow(tuple(row))
+                else:
+                    buffer.write(json.dumps(dict(zip(BOOK_FIELDS, row)), ensure_ascii=False))
+                    buffer.write('\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        cur.close()
@@ -0,0 +1,284 @@
+import base64
+import binascii
+import json
+import os
+from functools import lru_cache
+from db.search import build_match, bm25_expr
+
+# Поля, по которым разрешена сортировка каталога (совпадают с формой сортировки)
+SORT_FIELDS = ('title', 'author', 'pages', 'publisher')
+SORT_ORDERS = ('asc', 'desc')
+# Режим приблизительного подсчета для комбинированных фильтров: считаем
+# не больше APPROX_COUNT_LIMIT совпадений (0 - всегда точный COUNT)
+APPROX_COUNT_LIMIT = int(os.environ.get('APPROX_COUNT_LIMIT', 0))
+
+# Сортировка по релевантности (bm25) доступна только вместе с поиском q=
+SEARCH_SORT_FIELD = 'relevance'
+
+# Столбцы книги, которые читает каталог (явный список вместо SELECT *)
+BOOK_COLUMNS = ('id', 'title', 'author', 'pages', 'publisher', 'cover_image')
+_BOOK_COLUMN_SET = frozenset(BOOK_COLUMNS)
+
+
+def catalog_generation(cur):
+    """Текущее поколение каталога: растет при каждом изменении таблицы books"""
+    cur.execute("SELECT value FROM catalog_meta WHERE key = 'generation'")
+    return cur.fetchone()[0]
+
+
+def filters_from_args(args):
+    """Фильтры каталога из параметров запроса (общие для HTML и API)"""
+    return {
+        'q': args.get('q', '').strip(),
+        'title': args.get('title', ''),
+        'author': args.get('author', ''),
+        'publisher': args.get('publisher', ''),
+        'pages_min': args.get('pages_min', ''),
+        'pages_max': args.get('pages_max', '')
+    }
+
+
+def normalize_sort(sort_field, sort_order, search=False):
+    """Приводит параметры сортировки к допустимым значениям"""
+    if sort_field not in SORT_FIELDS and not (search and sort_field == SEARCH_SORT_FIELD):
+        sort_field = SEARCH_SORT_FIELD if search else 'title'
+    if sort_order not in SORT_ORDERS:
+        sort_order = 'asc'
+    return sort_field, sort_order
+
+
+# Условия фильтров в фиксированном порядке: текст WHERE зависит только
+# от набора заполненных фильтров, а не от их значений
+FILTER_CONDITIONS = (
+    ('q', "id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)"),
+    ('title', "title LIKE ?"),
+    ('author', "author = ?"),        # Точное совпадение для выпадающего списка
+    ('publisher', "publisher = ?"),  # Точное совпадение для выпадающего списка
+    ('pages_min', "pages >= ?"),
+    ('pages_max', "pages <= ?"),
+)
+MAX_FILTER_LENGTH = 200
+MAX_PAGES_DIGITS = 9
+
+
+class InvalidQuery(ValueError):
+    """Параметры каталога не прошли проверку - запрос отклоняется до обращения к базе"""
+
+
+def validate_filters(filters):
+    """Проверяет фильтры: страницы - целые неотрицательные числа,
+    строки не длиннее MAX_FILTER_LENGTH. Бросает InvalidQuery."""
+    for name, _ in FILTER_CONDITIONS:
+        if len(filters[name]) > MAX_FILTER_LENGTH:
+            raise InvalidQuery(f"{name}: не длиннее {MAX_FILTER_LENGTH} символов")
+    for name in ('pages_min', 'pages_max'):
+        value = filters[name]
+        if value and not (value.isascii() and value.isdigit() and len(value) <= MAX_PAGES_DIGITS):
+            raise InvalidQuery(f"{name} должен быть целым числом")
+    return filters
+
+
+def _filter_values(filters, with_search=True):
+    """(форма, параметры): форма - кортеж имен заполненных фильтров"""
+    shape = []
+    params = []
+    for name, _ in FILTER_CONDITIONS:
+        value = filters.get(name)
+        if not value:
+            continue
+        if name == 'q':
+            value = build_match(value) if with_search else None
+            if value is None:
+                continue
+        elif name == 'title':
+            value = f"%{value}%"
+        elif name in ('pages_min', 'pages_max'):
+            value = int(value)
+        shape.append(name)
+        params.append(value)
+    return tuple(shape), params
+
+
+_CONDITION_SQL = dict(FILTER_CONDITIONS)
+
+
+def build_where(filters, with_search=True):
+    """Строит WHERE-часть запроса и список параметров по фильтрам"""
+    shape, params = _filter_values(filters, with_search)
+    return [_CONDITION_SQL[name] for name in shape], params
+
+
+@lru_cache(maxsize=None)
+def _count_statement(shape, approx):
+    where_clause = " WHERE " + " AND ".join(_CONDITION_SQL[name] for name in shape) if shape else ""
+    if approx:
+        return f"SELECT COUNT(*) FROM (SELECT 1 FROM books{where_clause} LIMIT ?)"
+    return f"SELECT COUNT(*) FROM books{where_clause}"
+
+
+def count_books(cur, filters):
+    """Количество книг по фильтрам. Возвращает (count, exact).
+
+    Без фильтров и с одним фильтром по автору или издательству число
+    берется из таблицы счетчиков book_counts. Для прочих комбинаций -
+    COUNT(*), а при включенном APPROX_COUNT_LIMIT - счет с ограничением."""
+    active = {name for name, value in filters.items() if value}
+    if not active or active in ({'author'}, {'publisher'}):
+        facet = active.pop() if active else 'total'
+        value = filters[facet] if facet != 'total' else ''
+        cur.execute("SELECT count FROM book_counts WHERE facet = ? AND value = ?", (facet, value))
+        row = cur.fetchone()
+        return (row[0] if row else 0), True
+
+    shape, query_params = _filter_values(filters)
+
+    if APPROX_COUNT_LIMIT:
+        cur.execute(_count_statement(shape, True), query_params + [APPROX_COUNT_LIMIT])
+        total = cur.fetchone()[0]
+        return total, total < APPROX_COUNT_LIMIT
+
+    cur.execute(_count_statement(shape, False), query_params)
+    return cur.fetchone()[0], True
+
+
+# Порядковые номера полей сортировки в токене курсора (вместо имен)
+_CURSOR_FIELDS = SORT_FIELDS + (SEARCH_SORT_FIELD,)
+
+
+def encode_cursor(row, sort_field, sort_order):
+    """Кодирует позицию строки (значение поля сортировки, id) в непрозрачный токен"""
+    payload = [_CURSOR_FIELDS.index(sort_field), SORT_ORDERS.index(sort_order), row[sort_field], row['id']]
+    raw = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token, sort_field, sort_order):
+    """Возвращает (значение, id) из токена или None, если токен битый
+    или выдан для другой сортировки"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        field, order, value, book_id = json.loads(raw.decode('utf-8'))
+        if _CURSOR_FIELDS[field] != sort_field or SORT_ORDERS[order] != sort_order:
+            return None
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, IndexError):
+        return None
+    if not isinstance(book_id, int):
+        return None
+    return value, book_id
+
+
+# Режимы выборки страницы
+_PAGE_OFFSET, _PAGE_AFTER, _PAGE_BEFORE = 'offset', 'after', 'before'
+
+
+@lru_cache(maxsize=1024)
+def _page_statement(shape, sort_field, forward, mode, columns, ranked):
+    """Текст запроса страницы для одной формы (набор фильтров, сортировка,
+    режим пагинации, столбцы). Все аргументы берутся из белых списков,
+    поэтому форм конечное число, а одинаковый текст позволяет sqlite3
+    переиспользовать подготовленный запрос из кэша соединения."""
+    source = "books"
+    if ranked:
+        # Ранжирование bm25: меньше - релевантнее, поэтому asc = лучшие первыми
+        source = f"""(
+            SELECT {', '.join(f'books.{name}' for name in BOOK_COLUMNS)}, {bm25_expr()} AS relevance
+            FROM books_fts JOIN books ON books.id = books_fts.rowid
+            WHERE books_fts MATCH ?
+        )"""
+
+    where_conditions = [_CONDITION_SQL[name] for name in shape]
+    if mode != _PAGE_OFFSET:
+        # forward - направление обхода (для before уже перевернутое)
+        where_conditions.append(f"({sort_field}, id) {'>' if forward else '<'} (?, ?)")
+    where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
+
+    direction = 'ASC' if forward else 'DESC'
+    select_list = ", ".join(dict.fromkeys(['id', *columns, sort_field]))
+    query = f"""
+        SELECT {select_list} FROM {source}
+        {where_clause}
+        ORDER BY {sort_field} {direction}, id {direction}
+        LIMIT ?
+    """
+    if mode == _PAGE_OFFSET:
+        query += " OFFSET ?"
+    return query
+
+
+def fetch_page(cur, filters, sort_field, sort_order, per_page, after=None, before=None, page=1,
+               columns=None):
+    """Выбирает страницу книг.
+
+    При наличии курсора after/before используется keyset-пагинация
+    (WHERE (поле, id) > (?, ?)), которая не зависит от глубины страницы.
+    Иначе - старый режим LIMIT/OFFSET по номеру страницы.
+    columns - список нужных столбцов (по умолчанию BOOK_COLUMNS); id и поле
+    сортировки добавляются всегда, они нужны для курсора.
+    Возвращает (books, has_next, has_prev, by_cursor); by_cursor - страница
+    выбрана по курсору (битый или чужой токен дает обычную выборку по номеру).
+    """
+    if sort_field not in _CURSOR_FIELDS or sort_order not in SORT_ORDERS:
+        raise InvalidQuery(f"Недопустимая сортировка: {sort_field} {sort_order}")
+    columns = tuple(columns) if columns else BOOK_COLUMNS
+    if not set(columns) <= _BOOK_COLUMN_SET:
+        raise InvalidQuery(f"Недопустимые столбцы: {', '.join(columns)}")
+
+    source_params = []
+    match = build_match(filters.get('q'))
+    ranked = sort_field == SEARCH_SORT_FIELD and match is not None
+    if ranked:
+        source_params.append(match)
+        shape, query_params = _filter_values(filters, with_search=False)
+    else:
+        shape, query_params = _filter_values(filters)
+        if sort_field == SEARCH_SORT_FIELD:
+            sort_field = 'title'
+
+    forward = sort_order == 'asc'
+    after_key = decode_cursor(after, sort_field, sort_order)
+    before_key = decode_cursor(before, sort_field, sort_order) if after_key is None else None
+
+    mode = _PAGE_OFFSET
+    if after_key is not None:
+        mode = _PAGE_AFTER
+        query_params.extend(after_key)
+    elif before_key is not None:
+        # Идем назад: переворачиваем порядок, затем разворачиваем результат
+        mode = _PAGE_BEFORE
+        query_params.extend(before_key)
+        forward = not forward
+
+    # Берем на одну строку больше, чтобы понять, есть ли продолжение
+    query_params.append(per_page + 1)
+
+    offset = 0
+    if mode == _PAGE_OFFSET:
+        offset = (max(page, 1) - 1) * per_page
+        query_params.append(offset)
+
+    cur.execute(_page_statement(shape, sort_field, forward, mode, columns, ranked),
+                source_params + query_params)
+    books = cur.fetchall()
+    has_more = len(books) > per_page
+    books = books[:per_page]
+
+    if before_key is not None:
+        books.reverse()
+        return books, True, has_more, True
+    if after_key is not None:
+        return books, has_more, True, True
+    return books, has_more, offset > 0, False
+
+
+def iter_books(cur, filters, sort_field, sort_order, columns=None, after=None, chunk_size=1000):
+    """Обходит все книги по фильтрам keyset-страницами по chunk_size строк.
+    В памяти одновременно держится только одна порция."""
+    while True:
+        books, has_next, _, _ = fetch_page(cur, filters, sort_field, sort_order, chunk_size,
+                                           after=after, columns=columns)
+        yield from books
+        if not has_next or not books:
+            return
+        after = encode_cursor(books[-1], sort_field, sort_order)
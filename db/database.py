@@ -1,24 +1,391 @@
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
 from pathlib import Path
-from werkzeug.security import generate_password_hash
-
-def db_connect():
-    # SQLite подключение
-    dir_path = Path(__file__).parent
-    db_path = dir_path / "database.db"
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
+from flask import g, has_app_context, has_request_context, session
+
+try:
+    import fcntl
+except ImportError:
+    # Нет flock (Windows): каждый процесс обновляет копию сам
+    fcntl = None
+
+# Путь к базе вычисляется один раз при импорте, а не на каждом подключении
+DB_PATH = Path(os.environ.get('DATABASE_PATH', Path(__file__).parent / "database.db"))
+
+# Настройки пула и PRAGMA, которые выставляются один раз на соединение
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+DB_CACHE_SIZE = int(os.environ.get('DB_CACHE_SIZE', -16000))  # в КиБ, если отрицательное
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 5.0))
+# Размер кэша подготовленных запросов sqlite3 на соединение: формы запросов
+# каталога (db/catalog.py) повторяются и должны в нем помещаться
+DB_STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', 512))
+
+
+# Откуда читает каталог:
+#   wal     - read-only соединения к основной базе; в режиме WAL каждое
+#             чтение видит свой снимок и не ждет писателя (по умолчанию);
+#   replica - read-only соединения к копии базы, которую фоновый поток
+#             обновляет через backup API после изменений (не чаще раза в
+#             DB_REPLICA_INTERVAL секунд); при нескольких воркерах копию
+#             обновляет один из них. Подходит для небольших баз с
+#             тяжелыми записями: копируется вся база целиком.
+DB_READ_MODE = os.environ.get('DB_READ_MODE', 'wal')
+DB_REPLICA_PATH = Path(os.environ.get('DB_REPLICA_PATH', DB_PATH.with_name(DB_PATH.stem + '.replica.db')))
+DB_REPLICA_INTERVAL = float(os.environ.get('DB_REPLICA_INTERVAL', 2.0))
+# Копия обновляется шагами: страниц за шаг и пауза между шагами, секунды
+DB_REPLICA_STEP_PAGES = int(os.environ.get('DB_REPLICA_STEP_PAGES', 1024))
+DB_REPLICA_STEP_SLEEP = float(os.environ.get('DB_REPLICA_STEP_SLEEP', 0.005))
+# Сколько запросов процесса могут писать одновременно. 1 - очередь из
+# одного писателя: остальные ждут соединение до DB_WRITE_TIMEOUT секунд
+# в пуле, а не на блокировке SQLite
+DB_WRITERS = int(os.environ.get('DB_WRITERS', 1))
+DB_WRITE_TIMEOUT = float(os.environ.get('DB_WRITE_TIMEOUT', 10.0))
+
+READ_MODES = ('wal', 'replica')
+
+logger = logging.getLogger(__name__)
+
+
+class DatabaseBusy(sqlite3.OperationalError):
+    """Писатель не освободился за DB_WRITE_TIMEOUT"""
+
+
+class PooledConnection(sqlite3.Connection):
+    """Соединение, которое знает, в какой пул его вернуть"""
+    pool = None
+    # Класс курсора по умолчанию (services.metrics подменяет его на замеряющий)
+    cursor_class = sqlite3.Cursor
+    _after_commit = ()
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or self.cursor_class)
+
+    def after_commit(self, func):
+        """func() вызывается один раз после фиксации текущей транзакции;
+        при откате - не вызывается"""
+        if func not in self._after_commit:
+            self._after_commit = self._after_commit + (func,)
+
+    def commit(self):
+        super().commit()
+        callbacks, self._after_commit = self._after_commit, ()
+        for func in callbacks:
+            func()
+
+    def rollback(self):
+        self._after_commit = ()
+        super().rollback()
+
+
+class ConnectionPool:
+    """Потокобезопасный пул настроенных соединений SQLite.
+
+    Соединение выдается одному запросу за раз, поэтому check_same_thread
+    отключен: возвращаться в пул оно может из любого потока.
+    limit ограничивает число одновременно выданных соединений
+    (для пула записи - очередь писателей).
+    """
+
+    def __init__(self, path, readonly=False, size=DB_POOL_SIZE, limit=None, on_release=None):
+        self.path = path
+        self.readonly = readonly
+        self.size = size
+        self.on_release = on_release
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(limit) if limit else None
+
+    def _create(self):
+        # Писатель сразу берет блокировку записи (BEGIN IMMEDIATE): транзакция,
+        # начатая чтением, не может упасть с "database is locked" при переходе к записи
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT, cached_statements=DB_STATEMENT_CACHE,
+                               isolation_level='DEFERRED' if self.readonly else 'IMMEDIATE',
+                               check_same_thread=False, factory=PooledConnection)
+        conn.pool = self
+        conn.row_factory = sqlite3.Row
+        if self.readonly:
+            conn.execute("PRAGMA query_only = ON")
+        else:
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = {DB_CACHE_SIZE}")
+        return conn
+
+    def acquire(self, timeout=DB_WRITE_TIMEOUT):
+        if self._slots is not None and not self._slots.acquire(timeout=timeout):
+            raise DatabaseBusy("database is busy: writer queue timeout")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._create()
+        except Exception:
+            if self._slots is not None:
+                self._slots.release()
+            raise
+
+    def release(self, conn):
+        # Незакоммиченные изменения не должны утекать в следующий запрос
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._idle.qsize() < self.size:
+                self._idle.put(conn)
+            else:
+                self._close(conn)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+        if self.on_release:
+            self.on_release()
+
+    def _close(self, conn):
+        # Перед закрытием писатель обновляет устаревшую статистику
+        # планировщика (рекомендация SQLite для PRAGMA optimize)
+        if not self.readonly:
+            try:
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                logger.debug("PRAGMA optimize failed on close", exc_info=True)
+        conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+class Replica:
+    """Копия основной базы для чтения. Фоновый поток раз в interval секунд
+    переносит в нее изменения через backup API, если основная база
+    изменилась (PRAGMA data_version или запись в этом процессе): частые
+    записи дают не больше одного копирования за interval. Копирование
+    идет шагами по DB_REPLICA_STEP_PAGES страниц с паузой между ними,
+    чтобы не держать чтение основной базы (и контрольные точки WAL)
+    на все время копирования.
+
+    Копия в режиме WAL: читатели продолжают работать со своим снимком,
+    пока в нее записывается новая версия.
+
+    Копию обновляет один процесс - владелец блокировки <копия>.lock
+    (flock). Остальные воркеры только читают ее и раз в interval секунд
+    пробуют стать владельцем, если прежний завершился."""
+
+    def __init__(self, source, path, interval=DB_REPLICA_INTERVAL):
+        self.source = source
+        self.path = path
+        self.interval = interval
+        self.owner = False
+        self._version = None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._source = sqlite3.connect(source, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+        self._lock_fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self._wait_ready()
+        self._thread = threading.Thread(target=self._run, name='db-replica', daemon=True)
+        self._thread.start()
+
+    def _lead(self):
+        """Пытается стать владельцем копии (без ожидания)"""
+        if not self.owner:
+            if fcntl is None:
+                self.owner = True
+            else:
+                try:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.owner = True
+                except BlockingIOError:
+                    return False
+            logger.info("replica owner pid=%s path=%s", os.getpid(), self.path)
+            self.refresh(force=True)
+        return True
+
+    def _ready(self):
+        try:
+            target = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT)
+        except sqlite3.OperationalError:
+            return False
+        try:
+            return target.execute("SELECT 1 FROM sqlite_master WHERE name = 'books'").fetchone() is not None
+        except sqlite3.Error:
+            return False
+        finally:
+            target.close()
+
+    def _wait_ready(self):
+        # Пока владелец не записал первую копию, читать нечего
+        deadline = time.monotonic() + DB_WRITE_TIMEOUT
+        while not self._lead() and not self._ready():
+            if time.monotonic() > deadline:
+                raise DatabaseBusy(f"replica is not ready: {self.path}")
+            time.sleep(0.05)
+
+    def refresh(self, force=False):
+        if not self.owner:
+            return False
+        with self._lock:
+            version = self._source.execute("PRAGMA data_version").fetchone()[0]
+            if not force and not self._dirty and version == self._version:
+                return False
+            self._dirty = False
+            target = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT)
+            try:
+                self._source.backup(target, pages=DB_REPLICA_STEP_PAGES, sleep=DB_REPLICA_STEP_SLEEP)
+            finally:
+                target.close()
+            self._version = version
+            return True
+
+    def notify(self):
+        """Запись в этом процессе: копия обновится в ближайший проход"""
+        self._dirty = True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                if self._lead():
+                    self.refresh()
+            except sqlite3.Error:
+                logger.exception("replica refresh failed path=%s", self.path)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._source.close()
+        # Закрытие дескриптора снимает flock: владельцем станет другой процесс
+        os.close(self._lock_fd)
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+_replica = {'instance': None}
+
+
+def _wrote():
+    replica = _replica['instance']
+    if replica is not None:
+        replica.notify()
+
+
+def get_pool(readonly=False, primary=False):
+    """Пул текущего процесса. После fork (несколько воркеров) пулы
+    создаются заново: соединения SQLite нельзя делить между процессами.
+
+    readonly=True в режиме replica читает копию базы; primary=True
+    заставляет читать основную базу (свои только что записанные данные)."""
+    global _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _replica['instance'] = None
+            _pools_pid = os.getpid()
+        if not readonly:
+            key = 'rw'
+        elif DB_READ_MODE == 'replica' and not primary:
+            key = 'replica'
+        else:
+            key = 'ro'
+        pool = _pools.get(key)
+        if pool is None:
+            if key == 'rw':
+                pool = ConnectionPool(DB_PATH, limit=DB_WRITERS, size=max(DB_WRITERS, 1), on_release=_wrote)
+            elif key == 'replica':
+                _replica['instance'] = Replica(DB_PATH, DB_REPLICA_PATH)
+                pool = ConnectionPool(DB_REPLICA_PATH, readonly=True)
+            else:
+                pool = ConnectionPool(DB_PATH, readonly=True)
+            _pools[key] = pool
+        return pool
+
+
+def configure(read_mode=None, writers=None, replica_interval=None):
+    """Меняет режим чтения и очередь записи (для бенчмарков и тестов).
+    Текущие пулы закрываются, новые создаются лениво."""
+    global DB_READ_MODE, DB_WRITERS, DB_REPLICA_INTERVAL
+    if read_mode is not None:
+        if read_mode not in READ_MODES:
+            raise ValueError(f"Неизвестный режим чтения: {read_mode}")
+        DB_READ_MODE = read_mode
+    if writers is not None:
+        DB_WRITERS = writers
+    if replica_interval is not None:
+        DB_REPLICA_INTERVAL = replica_interval
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close_all()
+        _pools.clear()
+        if _replica['instance'] is not None and _pools_pid == os.getpid():
+            _replica['instance'].close()
+        _replica['instance'] = None
+
+
+def _read_own_writes():
+    # Администратор после правки сразу видит результат: в режиме replica
+    # его запросы читают основную базу, а не копию
+    return DB_READ_MODE == 'replica' and has_request_context() and session.get('is_admin')
+
+
+def db_connect(readonly=False):
+    """Соединение из пула. Внутри контекста приложения соединение одно
+    на весь запрос. Соединение записи возвращается в пул в db_close
+    (чтобы не держать очередь писателей), чтения - при завершении контекста."""
+    if has_app_context():
+        key = '_db_ro' if readonly else '_db_rw'
+        conn = g.get(key)
+        if conn is None:
+            conn = get_pool(readonly, primary=readonly and _read_own_writes()).acquire()
+            setattr(g, key, conn)
+    else:
+        conn = get_pool(readonly).acquire()
     cur = conn.cursor()
 
     return conn, cur
 
 def db_close(conn, cur):
+    if has_app_context():
+        if conn is g.get('_db_rw'):
+            conn.commit()
+            cur.close()
+            g.pop('_db_rw')
+            conn.pool.release(conn)
+        elif conn is g.get('_db_ro'):
+            conn.commit()
+            cur.close()
+        # Иначе соединение уже возвращено в пул повторным db_close
+        return
     conn.commit()
     cur.close()
-    conn.close()
+    # Вне контекста приложения некому вернуть соединение - делаем это сразу
+    conn.pool.release(conn)
+
+def release_db(exc=None):
+    """Возвращает соединения запроса в пул (teardown_appcontext)"""
+    for key in ('_db_ro', '_db_rw'):
+        conn = g.pop(key, None)
+        if conn is not None:
+            conn.pool.release(conn)
+
+def init_app(app):
+    app.teardown_appcontext(release_db)
 
 def init_db():
     """Инициализация базы данных с тестовыми данными"""
+    # Нужны только команде init-db, воркерам их импорт ни к чему
+    from werkzeug.security import generate_password_hash
+    from db.migrations import apply_migrations
+    from db.maintenance import enable_incremental_vacuum, schedule_maintenance, DB_MAINTENANCE_INTERVAL
+    from services.hashing import PASSWORD_HASH_METHOD
+
     conn, cur = db_connect()
     
     # Создание таблицы пользователей
@@ -43,15 +410,13 @@ def init_db():
         )
     ''')
     
-    # Создание администратора
-    admin_password = generate_password_hash('admin123')
-    try:
+    # Создание администратора (хэш считаем, только если админа еще нет)
+    if not cur.execute("SELECT id FROM users WHERE username = 'admin'").fetchone():
+        admin_password = generate_password_hash('admin123', PASSWORD_HASH_METHOD)
         cur.execute(
             "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
             ('admin', admin_password, True)
         )
-    except sqlite3.IntegrityError:
-        pass  # Админ уже существует
     
     # Добавление тестовых книг (минимум 100)
     books_count = cur.execute("SELECT COUNT(*) FROM books").fetchone()[0]
@@ -94,4 +459,15 @@ def init_db():
             sample_books
         )
     
+    # Миграции схемы (индексы и т.п.) поверх базовых таблиц
+    conn.commit()
+    apply_migrations(conn)
+    
+    # Новая база сразу переходит на incremental auto_vacuum (VACUUM
+    # свежей базы мгновенный); существующую переводит `flask db vacuum`
+    if books_count == 0:
+        enable_incremental_vacuum(conn)
+    # Плановое обслуживание дальше перепланирует себя само
+    schedule_maintenance(cur, delay=DB_MAINTENANCE_INTERVAL)
+    
     db_close(conn, cur)
\ No newline at end of file
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+from db.catalog import catalog_generation
+
+# Каталог для общего файлового кэша фасетов между воркерами (по желанию)
+FACET_CACHE_DIR = os.environ.get('FACET_CACHE_DIR')
+
+FACETS = ('author', 'publisher')
+
+# Кэш процесса: поколение каталога и списки [(значение, количество), ...]
+_state = {'generation': None, 'author': None, 'publisher': None}
+_lock = threading.Lock()
+
+
+def _cache_file(generation):
+    return os.path.join(FACET_CACHE_DIR, f"facets-{generation}.json")
+
+
+def _load_file(generation):
+    if not FACET_CACHE_DIR:
+        return None
+    try:
+        with open(_cache_file(generation), encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {facet: [tuple(item) for item in data[facet]] for facet in FACETS}
+
+
+def _store_file(generation, data):
+    if not FACET_CACHE_DIR:
+        return
+    os.makedirs(FACET_CACHE_DIR, exist_ok=True)
+    path = _cache_file(generation)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        # Файлы прошлых поколений больше никому не нужны
+        for name in os.listdir(FACET_CACHE_DIR):
+            if name.startswith('facets-') and name.endswith('.json') and name != os.path.basename(path):
+                os.remove(os.path.join(FACET_CACHE_DIR, name))
+    except OSError:
+        pass
+
+
+def _query_facets(cur):
+    data = {}
+    for facet in FACETS:
+        # Количества уже поддерживаются триггерами в book_counts
+        cur.execute("SELECT value, count FROM book_counts WHERE facet = ? ORDER BY value", (facet,))
+        data[facet] = [(row[0], row[1]) for row in cur.fetchall()]
+    return data
+
+
+def get_facets(cur, generation=None):
+    """Возвращает (authors, publishers) - списки (значение, количество книг).
+    Пересчет идет только при смене поколения каталога."""
+    if generation is None:
+        generation = catalog_generation(cur)
+    with _lock:
+        if _state['generation'] == generation:
+            return _state['author'], _state['publisher']
+
+    data = _load_file(generation)
+    if data is None:
+        data = _query_facets(cur)
+        _store_file(generation, data)
+
+    with _lock:
+        _state.update(data, generation=generation)
+    return data['author'], data['publisher']
+
+
+def _adjust(items, value, delta):
+    for i, (name, count) in enumerate(items):
+        if name == value:
+            if count + delta > 0:
+                items[i] = (name, count + delta)
+            else:
+                del items[i]
+            return
+        if name > value:
+            break
+    else:
+        i = len(items)
+    if delta > 0:
+        items.insert(i, (value, delta))
+
+
+def facets_changed(generation, old=None, new=None):
+    """Обновляет кэш после записи в books.
+
+    generation - поколение, прочитанное в транзакции записи;
+    old/new - значения {'author': ..., 'publisher': ...} до и после
+    (None для добавления/удаления). Если кэш отстает ровно на одно
+    изменение, он правится на месте, иначе сбрасывается."""
+    with _lock:
+        if _state['generation'] != generation - 1:
+            _state['generation'] = None
+            return
+        for facet in FACETS:
+            items = list(_state[facet])
+            if old:
+                _adjust(items, old[facet], -1)
+            if new:
+                _adjust(items, new[facet], +1)
+            _state[facet] = items
+        _state['generation'] = generation
+        data = {facet: _state[facet] for facet in FACETS}
+    _store_file(generation, data)
@@ -0,0 +1,346 @@
+import logging
+import os
+import random
+import sqlite3
+import time
+from bisect import bisect
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import accumulate
+import click
+from flask.cli import AppGroup
+from db.database import DB_CACHE_SIZE, DB_MMAP_SIZE, DB_PATH, db_connect, db_close
+from db.bulk import import_books
+from services import metrics
+from services.jobs import task, enqueue
+from services.page_cache import CACHE_METRIC
+
+# Плановое обслуживание (PRAGMA optimize, возврат свободных страниц)
+# выполняется очередью задач не чаще раза в столько секунд
+DB_MAINTENANCE_INTERVAL = float(os.environ.get('DB_MAINTENANCE_INTERVAL', 6 * 3600))
+# Свободные страницы возвращаются файловой системе, когда их больше этой доли файла
+DB_FREELIST_THRESHOLD = float(os.environ.get('DB_FREELIST_THRESHOLD', 0.1))
+# Сколько страниц освобождать за один проход incremental_vacuum
+DB_VACUUM_PAGES = int(os.environ.get('DB_VACUUM_PAGES', 2000))
+
+# Настройки соединения на время массовой загрузки: без fsync, большой кэш,
+# без контрольных точек WAL посреди загрузки
+BULK_PRAGMAS = {'synchronous': 'OFF', 'cache_size': -256000, 'temp_store': 'MEMORY', 'wal_autocheckpoint': 0}
+
+# Словарь для синтетических названий, авторов и издательств
+WORDS = ('война', 'мир', 'тень', 'город', 'море', 'ветер', 'звезда', 'дорога', 'сад', 'остров',
+         'ночь', 'огонь', 'зима', 'лето', 'история', 'тайна', 'книга', 'время', 'песня', 'небо',
+         'дом', 'река', 'лес', 'сердце', 'память', 'берег', 'свет', 'камень', 'птица', 'мост')
+FIRST_NAMES = ('Анна', 'Иван', 'Мария', 'Петр', 'Ольга', 'Сергей', 'Елена', 'Алексей', 'Наталья',
+               'Дмитрий', 'Фёдор', 'Юлия', 'Михаил', 'Татьяна', 'Николай', 'Лев')
+LAST_NAMES = ('Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Соколов', 'Михайлов',
+              'Новиков', 'Фёдоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семёнов',
+              'Егоров', 'Павлов', 'Козлов', 'Степанов', 'Николаев', 'Орлов')
+
+AUTO_VACUUM_MODES = {0: 'none', 1: 'full', 2: 'incremental'}
+
+logger = logging.getLogger(__name__)
+
+
+# --- Синтетические данные ---------------------------------------------------
+
+def _picker(rng, n, skew):
+    """Индекс 0..n-1: при skew > 0 - закон Ципфа (вес k-го значения
+    1 / k^skew: несколько популярных авторов и длинный хвост),
+    при skew = 0 - равномерное распределение"""
+    if skew <= 0:
+        return lambda: rng.randrange(n)
+    cum_weights = list(accumulate(1 / k ** skew for k in range(1, n + 1)))
+    total = cum_weights[-1]
+    return lambda: bisect(cum_weights, rng.random() * total)
+
+
+def synthetic_books(count, seed=1, authors=None, publishers=None, skew=1.0):
+    """Генератор словарей книг для import_books. По умолчанию один автор
+    на 20 книг и одно издательство на 5000."""
+    rng = random.Random(seed)
+    authors = authors or max(50, count // 20)
+    publishers = publishers or max(10, count // 5000)
+    author_names = [f"{first} {last}{'а' if first[-1] == 'а' else ''} {i}"
+                    for i, (first, last) in enumerate(
+                        (rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)) for _ in range(authors))]
+    publisher_names = [f"Издательство {rng.choice(WORDS).capitalize()} {i}" for i in range(publishers)]
+    pick_author = _picker(rng, authors, skew)
+    pick_publisher = _picker(rng, publishers, skew)
+    for i in range(count):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).capitalize()
+        yield {
+            'title': f"{title} {i}",
+            'author': author_names[pick_author()],
+            'pages': max(16, int(rng.lognormvariate(5.7, 0.5))),
+            'publisher': publisher_names[pick_publisher()],
+        }
+
+
+def connect(path=DB_PATH):
+    """Отдельное соединение для обслуживания и загрузки, вне пула:
+    без неявных транзакций, чтобы работали VACUUM и PRAGMA"""
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+@contextmanager
+def bulk_load(conn, drop_indexes=False):
+    """Настройки соединения для массовой загрузки. drop_indexes - удалить
+    вторичные индексы books и построить их заново после загрузки (быстрее
+    построчного обновления B-деревьев на больших объемах; уникальный
+    индекс остается - по нему работает UPSERT)."""
+    saved = {name: conn.execute(f"PRAGMA {name}").fetchone()[0] for name in BULK_PRAGMAS}
+    for name, value in BULK_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    indexes = []
+    if drop_indexes:
+        indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'books' "
+                               "AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'").fetchall()
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX "{name}"')
+    try:
+        yield conn
+    finally:
+        for _, sql in indexes:
+            conn.execute(sql)
+        for name, value in saved.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def seed_books(conn, count, seed=1, authors=None, publishers=None, skew=1.0, batch_size=20000,
+               progress=None):
+    """Заливает count синтетических книг пачками (import_books) и обновляет
+    статистику планировщика. Возвращает статистику импорта."""
+    empty = conn.execute("SELECT NOT EXISTS (SELECT 1 FROM books)").fetchone()[0]
+    # Индексы перестраиваются заново, только если загрузка их перекрывает
+    with bulk_load(conn, drop_indexes=empty and count >= 100000):
+        stats = import_books(conn, synthetic_books(count, seed, authors, publishers, skew),
+                             batch_size=batch_size, progress=progress)
+    conn.execute("ANALYZE")
+    return stats
+
+
+# --- Обслуживание -------------------------------------------------------------
+
+def storage_info(conn):
+    page_size, page_count, freelist, auto_vacuum = (
+        conn.execute(f"PRAGMA {name}").fetchone()[0]
+        for name in ('page_size', 'page_count', 'freelist_count', 'auto_vacuum'))
+    return {'page_size': page_size, 'page_count': page_count, 'freelist_count': freelist,
+            'auto_vacuum': AUTO_VACUUM_MODES.get(auto_vacuum, auto_vacuum)}
+
+
+def enable_incremental_vacuum(conn):
+    """Переводит базу в auto_vacuum = INCREMENTAL. Для базы с таблицами
+    режим меняется только полным VACUUM (перезапись файла)."""
+    if storage_info(conn)['auto_vacuum'] == 'incremental':
+        return False
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def vacuum(conn):
+    """Полная перестройка файла: дефрагментация и возврат всех свободных
+    страниц. Блокирует запись на все время работы."""
+    before = storage_info(conn)
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    after = storage_info(conn)
+    return before['page_count'] * before['page_size'], after['page_count'] * after['page_size']
+
+
+def maintain(conn, analyze=False):
+    """Плановое обслуживание, короткое и безопасное под нагрузкой:
+    PRAGMA optimize (ANALYZE только там, где статистика устарела) или
+    полный ANALYZE, и возврат свободных страниц, если их накопилось много."""
+    started = time.perf_counter()
+    conn.commit()
+    conn.execute("ANALYZE" if analyze else "PRAGMA optimize")
+    info = storage_info(conn)
+    freed = 0
+    if (info['auto_vacuum'] == 'incremental'
+            and info['freelist_count'] > DB_FREELIST_THRESHOLD * info['page_count']):
+        # Через execute() модуль sqlite3 делает один шаг прагмы и освобождает
+        # одну страницу; executescript выполняет ее до конца
+        conn.executescript(f"PRAGMA incremental_vacuum({DB_VACUUM_PAGES})")
+        freed = info['freelist_count'] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # WAL после больших записей сам не уменьшается; если читатели еще
+    # держат старый снимок, контрольная точка просто не обрежет файл
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    conn.commit()
+    logger.info("db maintenance analyze=%s freed_pages=%d ms=%.1f",
+                analyze, freed, (time.perf_counter() - started) * 1000)
+    return {'freed_pages': freed, **storage_info(conn)}
+
+
+@task('db.maintenance')
+def maintenance_task(reschedule=True):
+    conn, cur = db_connect()
+    try:
+        maintain(conn)
+        if reschedule:
+            schedule_maintenance(cur, delay=DB_MAINTENANCE_INTERVAL)
+    finally:
+        db_close(conn, cur)
+
+
+def schedule_maintenance(cur, delay=0):
+    """Плановое обслуживание - периодическая задача очереди (перепланирует
+    себя сама). delay = 0 - внеочередной проход, например после импорта."""
+    if delay:
+        enqueue(cur, 'db.maintenance', {'reschedule': True}, key='db.maintenance', delay=delay)
+    else:
+        enqueue(cur, 'db.maintenance', {'reschedule': False}, key='db.maintenance:now')
+
+
+def size_report(conn):
+    """Размеры таблиц и индексов по dbstat: [(имя, тип, страниц, байт, не занято байт)]"""
+    try:
+        rows = conn.execute(
+            """SELECT s.name, coalesce(m.type, 'table') AS type, COUNT(*) AS pages,
+                      SUM(s.pgsize) AS bytes, SUM(s.unused) AS unused
+               FROM dbstat AS s LEFT JOIN sqlite_master AS m ON m.name = s.name
+               GROUP BY s.name ORDER BY bytes DESC""").fetchall()
+    except sqlite3.OperationalError:
+        # SQLite собран без SQLITE_ENABLE_DBSTAT_VTAB
+        return None
+    return [tuple(row) for row in rows]
+
+
+def stat_freshness(conn):
+    """Таблицы без статистики планировщика (sqlite_stat1) - кандидаты на ANALYZE"""
+    try:
+        analyzed = {row[0] for row in conn.execute("SELECT DISTINCT tbl FROM sqlite_stat1")}
+    except sqlite3.OperationalError:
+        analyzed = set()
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND sql NOT LIKE 'CREATE VIRTUAL%' "
+        "AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'books_fts_%'")]
+    return [name for name in tables if name not in analyzed]
+
+
+def cache_coverage(info, rows=None):
+    """Оценка вместо счетчиков попаданий в страничный кэш SQLite
+    (sqlite3_db_status модулем sqlite3 не предоставляется): какая доля
+    файла и таблицы books с индексами помещается в кэш страниц одного
+    соединения (cache_size) и в mmap. При 100% повторные чтения
+    каталога не обращаются к диску."""
+    size = max(info['page_count'] * info['page_size'], 1)
+    cache = -DB_CACHE_SIZE * 1024 if DB_CACHE_SIZE < 0 else DB_CACHE_SIZE * info['page_size']
+    coverage = {'cache_bytes': cache, 'mmap_bytes': DB_MMAP_SIZE,
+                'cache_share': min(1.0, cache / size), 'mmap_share': min(1.0, DB_MMAP_SIZE / size)}
+    if rows:
+        catalog = sum(row[3] for row in rows if row[0] == 'books' or row[0].startswith('idx_books'))
+        coverage['catalog_bytes'] = catalog
+        coverage['catalog_share'] = min(1.0, cache / max(catalog, 1))
+    return coverage
+
+
+def app_cache_hits():
+    """Попадания в кэш страниц и фрагментов приложения {вид: (hit, miss)}
+    по снимкам метрик воркеров; None, если METRICS_DIR не задан"""
+    if not metrics.METRICS_DIR:
+        return None
+    totals = defaultdict(lambda: [0, 0])
+    for name, labels, value in metrics.merged_snapshot(include_self=False)['counters']:
+        if name == CACHE_METRIC:
+            totals[labels['cache']][labels['result'] == 'miss'] += value
+    return {kind: tuple(values) for kind, values in totals.items()}
+
+
+def _mb(value):
+    return f"{value / (1024 * 1024):.2f} МБ"
+
+
+db_cli = AppGroup('db', help='Обслуживание базы данных')
+
+
+@db_cli.command('seed')
+@click.option('--books', 'count', type=int, default=100000, show_default=True)
+@click.option('--authors', type=int, help='Число авторов (по умолчанию книг / 20)')
+@click.option('--publishers', type=int, help='Число издательств (по умолчанию книг / 5000)')
+@click.option('--skew', type=float, default=1.0, show_default=True,
+              help='Показатель закона Ципфа для популярности авторов и издательств; 0 - равномерно')
+@click.option('--seed', type=int, default=1, show_default=True)
+@click.option('--batch-size', type=int, default=20000, show_default=True)
+def seed_command(count, authors, publishers, skew, seed, batch_size):
+    """Заполняет каталог синтетическими книгами (для нагрузочных проверок)"""
+    conn = connect()
+    started = time.perf_counter()
+
+    def progress(stats):
+        click.echo(f"\rЗагружено: {stats['processed']}  {time.perf_counter() - started:.0f}s", nl=False, err=True)
+
+    stats = seed_books(conn, count, seed, authors, publishers, skew, batch_size, progress)
+    conn.close()
+    click.echo(f"\nГотово: {stats['processed']} книг за {time.perf_counter() - started:.1f}s", err=True)
+
+
+@db_cli.command('maintain')
+@click.option('--analyze', is_flag=True, help='Полный ANALYZE вместо PRAGMA optimize')
+def maintain_command(analyze):
+    """Обновляет статистику планировщика и возвращает свободные страницы"""
+    conn = connect()
+    result = maintain(conn, analyze)
+    conn.close()
+    click.echo(f"Освобождено страниц: {result['freed_pages']}, "
+               f"свободных осталось: {result['freelist_count']} из {result['page_count']}", err=True)
+
+
+@db_cli.command('vacuum')
+def vacuum_command():
+    """Полный VACUUM (переводит базу в auto_vacuum = INCREMENTAL)"""
+    conn = connect()
+    before, after = vacuum(conn)
+    conn.close()
+    click.echo(f"Размер базы: {_mb(before)} -> {_mb(after)}", err=True)
+
+
+@db_cli.command('report')
+def report_command():
+    """Размеры таблиц и индексов, свободное место, свежесть статистики"""
+    conn = connect()
+    info = storage_info(conn)
+    rows = size_report(conn)
+    stale = stat_freshness(conn)
+    conn.close()
+
+    wal_path = f"{DB_PATH}-wal"
+    wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    total = info['page_count'] * info['page_size']
+    click.echo(f"Файл: {_mb(total)} ({info['page_count']} страниц по {info['page_size']} байт), WAL: {_mb(wal_size)}")
+    click.echo(f"Свободных страниц: {info['freelist_count']} "
+               f"({info['freelist_count'] / max(info['page_count'], 1):.1%}), auto_vacuum: {info['auto_vacuum']}")
+    if info['auto_vacuum'] != 'incremental':
+        click.echo("  свободное место не возвращается автоматически: выполните `flask db vacuum`")
+    if rows is None:
+        click.echo("Размеры по таблицам недоступны: SQLite без dbstat")
+    else:
+        click.echo(f"{'Объект':<32} {'тип':<6} {'страниц':>9} {'размер':>12} {'занято':>7}")
+        for name, kind, pages, size, unused in rows:
+            click.echo(f"{name:<32} {kind:<6} {pages:>9} {_mb(size):>12} {1 - unused / size:>7.0%}")
+    if stale:
+        click.echo(f"Нет статистики планировщика: {', '.join(stale)} - выполните `flask db maintain --analyze`")
+
+    coverage = cache_coverage(info, rows)
+    click.echo(f"Кэш страниц SQLite: {_mb(coverage['cache_bytes'])} на соединение - "
+               f"{coverage['cache_share']:.0%} файла"
+               + (f", {coverage['catalog_share']:.0%} books с индексами" if 'catalog_share' in coverage else '')
+               + f"; mmap: {_mb(coverage['mmap_bytes'])} - {coverage['mmap_share']:.0%} файла")
+    hits = app_cache_hits()
+    if hits is None:
+        click.echo(f"Попадания в кэш приложения: задайте METRICS_DIR или смотрите {CACHE_METRIC} в /metrics")
+    else:
+        for kind, (hit, miss) in sorted(hits.items()):
+            click.echo(f"Кэш приложения {kind}: {hit / max(hit + miss, 1):.1%} попаданий ({hit} из {hit + miss})")
+
+
+def init_app(app):
+    app.cli.add_command(db_cli)
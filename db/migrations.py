@@ -0,0 +1,286 @@
+import sqlite3
+from datetime import datetime
+
+
+def fold_sql(column):
+    """SQL-выражение ё -> е для значения, попадающего в полнотекстовый индекс"""
+    return f"replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+def _count_sql(row, sign):
+    """Тело триггера: изменить счетчики total/author/publisher для строки new/old"""
+    statements = []
+    for facet, value in (('total', "''"), ('author', f'{row}.author'), ('publisher', f'{row}.publisher')):
+        statements.append(
+            f"INSERT INTO book_counts (facet, value, count) VALUES ('{facet}', {value}, {sign}1) "
+            f"ON CONFLICT (facet, value) DO UPDATE SET count = count {sign} 1;"
+        )
+    if sign == '-':
+        for facet in ('author', 'publisher'):
+            statements.append(
+                f"DELETE FROM book_counts WHERE facet = '{facet}' AND value = {row}.{facet} AND count <= 0;"
+            )
+    return '\n               '.join(statements)
+
+
+_NOT_BULK = "(SELECT value FROM catalog_meta WHERE key = 'bulk_load') = 0"
+
+
+def _cover_ref_sql(row, sign):
+    """Тело триггера: изменить число ссылок на файл обложки строки new/old.
+    Строка с refs = 0 не удаляется - по ней services.covers находит мусор."""
+    if sign == '+':
+        return (f"INSERT INTO cover_refs (name, refs) SELECT {row}.cover_image, 1 "
+                f"WHERE {row}.cover_image IS NOT NULL "
+                f"ON CONFLICT (name) DO UPDATE SET refs = refs + 1;")
+    return f"UPDATE cover_refs SET refs = refs - 1 WHERE name = {row}.cover_image;"
+
+
+# Версионированные миграции схемы: (версия, описание, список SQL).
+# Новые шаги добавляются только в конец списка, уже выпущенные не меняются.
+MIGRATIONS = [
+    (1, 'Индексы для фильтров и сортировок каталога', [
+        # Индекс по полю неявно продолжается rowid (= id), поэтому он
+        # обслуживает и ORDER BY поле, id, и курсор (поле, id) > (?, ?)
+        "CREATE INDEX IF NOT EXISTS idx_books_title ON books (title)",
+        "CREATE INDEX IF NOT EXISTS idx_books_author ON books (author)",
+        "CREATE INDEX IF NOT EXISTS idx_books_publisher ON books (publisher)",
+        "CREATE INDEX IF NOT EXISTS idx_books_pages ON books (pages)",
+    ]),
+    (2, 'Уникальный индекс для проверки дубликатов книг', [
+        # Уже существующие дубли не удаляются, а переносятся в books_duplicates
+        # (kept_id - оставшаяся в каталоге книга), чтобы их можно было
+        # просмотреть и при необходимости вернуть вручную
+        """CREATE TABLE IF NOT EXISTS books_duplicates (
+               id INTEGER PRIMARY KEY,
+               kept_id INTEGER NOT NULL,
+               title TEXT NOT NULL,
+               author TEXT NOT NULL,
+               pages INTEGER NOT NULL,
+               publisher TEXT NOT NULL,
+               cover_image TEXT,
+               moved_at TEXT NOT NULL DEFAULT (datetime('now'))
+           )""",
+        """INSERT INTO books_duplicates (id, kept_id, title, author, pages, publisher, cover_image)
+           SELECT b.id, k.kept_id, b.title, b.author, b.pages, b.publisher, b.cover_image
+           FROM books b
+           JOIN (SELECT MIN(id) AS kept_id, title, author, publisher
+                 FROM books GROUP BY title, author, publisher HAVING COUNT(*) > 1) k
+             ON b.title = k.title AND b.author = k.author AND b.publisher = k.publisher
+           WHERE b.id != k.kept_id""",
+        "DELETE FROM books WHERE id IN (SELECT id FROM books_duplicates)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_books_unique ON books (title, author, publisher)",
+    ]),
+    (3, 'Счетчик поколений каталога для инвалидации кэшей', [
+        """CREATE TABLE IF NOT EXISTS catalog_meta (
+               key TEXT PRIMARY KEY,
+               value INTEGER NOT NULL
+           )""",
+        "INSERT OR IGNORE INTO catalog_meta (key, value) VALUES ('generation', 1)",
+        # Любое изменение books увеличивает поколение в той же транзакции
+        """CREATE TRIGGER IF NOT EXISTS books_generation_insert AFTER INSERT ON books BEGIN
+               UPDATE catalog_meta SET value = value + 1 WHERE key = 'generation';
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS books_generation_update AFTER UPDATE ON books BEGIN
+               UPDATE catalog_meta SET value = value + 1 WHERE key = 'generation';
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS books_generation_delete AFTER DELETE ON books BEGIN
+               UPDATE catalog_meta SET value = value + 1 WHERE key = 'generation';
+           END""",
+    ]),
+    (4, 'Полнотекстовый индекс books_fts по названию, автору и издательству', [
+        # Contentless-таблица: хранит только индекс, сами строки берутся из books.
+        # ё -> е сворачиваем сами, регистр сворачивает unicode61
+        """CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+               title, author, publisher,
+               content='',
+               tokenize='unicode61 remove_diacritics 2',
+               prefix='2 3 4'
+           )""",
+        f"""INSERT INTO books_fts (rowid, title, author, publisher)
+            SELECT id, {fold_sql('title')}, {fold_sql('author')}, {fold_sql('publisher')} FROM books""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+               INSERT INTO books_fts (rowid, title, author, publisher)
+               VALUES (new.id, {fold_sql('new.title')}, {fold_sql('new.author')}, {fold_sql('new.publisher')});
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+               INSERT INTO books_fts (books_fts, rowid, title, author, publisher)
+               VALUES ('delete', old.id, {fold_sql('old.title')}, {fold_sql('old.author')}, {fold_sql('old.publisher')});
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, publisher ON books BEGIN
+               INSERT INTO books_fts (books_fts, rowid, title, author, publisher)
+               VALUES ('delete', old.id, {fold_sql('old.title')}, {fold_sql('old.author')}, {fold_sql('old.publisher')});
+               INSERT INTO books_fts (rowid, title, author, publisher)
+               VALUES (new.id, {fold_sql('new.title')}, {fold_sql('new.author')}, {fold_sql('new.publisher')});
+           END""",
+    ]),
+    (5, 'Таблица счетчиков книг: всего и по каждому автору/издательству', [
+        """CREATE TABLE IF NOT EXISTS book_counts (
+               facet TEXT NOT NULL,
+               value TEXT NOT NULL,
+               count INTEGER NOT NULL,
+               PRIMARY KEY (facet, value)
+           ) WITHOUT ROWID""",
+        "DELETE FROM book_counts",
+        "INSERT INTO book_counts (facet, value, count) SELECT 'total', '', COUNT(*) FROM books",
+        """INSERT INTO book_counts (facet, value, count)
+           SELECT 'author', author, COUNT(*) FROM books GROUP BY author""",
+        """INSERT INTO book_counts (facet, value, count)
+           SELECT 'publisher', publisher, COUNT(*) FROM books GROUP BY publisher""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_counts_insert AFTER INSERT ON books BEGIN
+               {_count_sql('new', '+')}
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_counts_delete AFTER DELETE ON books BEGIN
+               {_count_sql('old', '-')}
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_counts_update AFTER UPDATE OF author, publisher ON books BEGIN
+               {_count_sql('old', '-')}
+               {_count_sql('new', '+')}
+           END""",
+    ]),
+    (6, 'Режим массовой загрузки: построчные триггеры вставки можно отключить', [
+        # Во время массового импорта флаг bulk_load = 1 выставляется внутри
+        # транзакции пачки, а индекс поиска, счетчики и поколение обновляются
+        # одним запросом на пачку (db/bulk.py). Другие соединения флаг не видят.
+        "INSERT OR IGNORE INTO catalog_meta (key, value) VALUES ('bulk_load', 0)",
+        "DROP TRIGGER IF EXISTS books_generation_insert",
+        "DROP TRIGGER IF EXISTS books_generation_update",
+        "DROP TRIGGER IF EXISTS books_fts_insert",
+        "DROP TRIGGER IF EXISTS books_counts_insert",
+        f"""CREATE TRIGGER books_generation_insert AFTER INSERT ON books WHEN {_NOT_BULK} BEGIN
+               UPDATE catalog_meta SET value = value + 1 WHERE key = 'generation';
+           END""",
+        f"""CREATE TRIGGER books_generation_update AFTER UPDATE ON books WHEN {_NOT_BULK} BEGIN
+               UPDATE catalog_meta SET value = value + 1 WHERE key = 'generation';
+           END""",
+        f"""CREATE TRIGGER books_fts_insert AFTER INSERT ON books WHEN {_NOT_BULK} BEGIN
+               INSERT INTO books_fts (rowid, title, author, publisher)
+               VALUES (new.id, {fold_sql('new.title')}, {fold_sql('new.author')}, {fold_sql('new.publisher')});
+           END""",
+        f"""CREATE TRIGGER books_counts_insert AFTER INSERT ON books WHEN {_NOT_BULK} BEGIN
+               {_count_sql('new', '+')}
+           END""",
+    ]),
+    (7, 'Счетчики ссылок на файлы обложек', [
+        """CREATE TABLE IF NOT EXISTS cover_refs (
+               name TEXT PRIMARY KEY,
+               refs INTEGER NOT NULL
+           ) WITHOUT ROWID""",
+        "DELETE FROM cover_refs",
+        """INSERT INTO cover_refs (name, refs)
+           SELECT cover_image, COUNT(*) FROM books WHERE cover_image IS NOT NULL GROUP BY cover_image""",
+        "CREATE INDEX IF NOT EXISTS idx_cover_refs_unused ON cover_refs (refs) WHERE refs <= 0",
+        f"""CREATE TRIGGER IF NOT EXISTS books_covers_insert AFTER INSERT ON books WHEN {_NOT_BULK} BEGIN
+               {_cover_ref_sql('new', '+')}
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_covers_delete AFTER DELETE ON books BEGIN
+               {_cover_ref_sql('old', '-')}
+           END""",
+        f"""CREATE TRIGGER IF NOT EXISTS books_covers_update AFTER UPDATE OF cover_image ON books
+           WHEN old.cover_image IS NOT new.cover_image BEGIN
+               {_cover_ref_sql('old', '-')}
+               {_cover_ref_sql('new', '+')}
+           END""",
+    ]),
+    (8, 'Составные индексы фильтр + сортировка по названию', [
+        # Фильтр по автору/издательству с сортировкой по умолчанию (title)
+        # читается по индексу в нужном порядке, без временного B-дерева.
+        # Одиночные индексы остаются: они неявно продолжаются id и нужны
+        # курсору по (author, id) / (publisher, id).
+        "CREATE INDEX IF NOT EXISTS idx_books_author_title ON books (author, title)",
+        "CREATE INDEX IF NOT EXISTS idx_books_publisher_title ON books (publisher, title)",
+        "ANALYZE",
+    ]),
+    (9, 'Очередь фоновых задач', [
+        # key - ключ идемпотентности: пока задача с тем же ключом ждет
+        # в очереди, повторная постановка ничего не добавляет
+        """CREATE TABLE IF NOT EXISTS jobs (
+               id INTEGER PRIMARY KEY,
+               task TEXT NOT NULL,
+               payload TEXT NOT NULL DEFAULT '{}',
+               key TEXT,
+               status TEXT NOT NULL DEFAULT 'queued',
+               attempts INTEGER NOT NULL DEFAULT 0,
+               max_attempts INTEGER NOT NULL,
+               run_at REAL NOT NULL,
+               locked_until REAL,
+               last_error TEXT,
+               created_at REAL NOT NULL,
+               updated_at REAL NOT NULL
+           )""",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_queued_key ON jobs (key) WHERE status = 'queued'",
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)",
+    ]),
+]
+
+# Запросы, которые должны обслуживаться индексами (формы запросов main.index и admin)
+INDEX_QUERIES = [
+    ("SELECT DISTINCT author FROM books ORDER BY author", ()),
+    ("SELECT DISTINCT publisher FROM books ORDER BY publisher", ()),
+    ("SELECT author, COUNT(*) FROM books GROUP BY author ORDER BY author", ()),
+    ("SELECT publisher, COUNT(*) FROM books GROUP BY publisher ORDER BY publisher", ()),
+    ("SELECT COUNT(*) FROM books WHERE author = ?", ('',)),
+    ("SELECT COUNT(*) FROM books WHERE publisher = ?", ('',)),
+    ("SELECT COUNT(*) FROM books WHERE pages >= ? AND pages <= ?", (0, 0)),
+    ("SELECT id FROM books WHERE title = ? AND author = ? AND publisher = ?", ('', '', '')),
+    ("SELECT id FROM books WHERE title = ? AND author = ? AND publisher = ? AND id != ?", ('', '', '', 0)),
+    ("SELECT id, title FROM books WHERE author = ? ORDER BY title ASC, id ASC LIMIT ?", ('', 1)),
+    ("SELECT id, title FROM books WHERE publisher = ? ORDER BY title ASC, id ASC LIMIT ?", ('', 1)),
+    ("SELECT rowid FROM books_fts WHERE books_fts MATCH ?", ('"x"*',)),
+] + [
+    (f"SELECT id, {field} FROM books WHERE ({field}, id) {op} (?, ?) "
+     f"ORDER BY {field} {direction}, id {direction} LIMIT ?", ('', 0, 1))
+    for field in ('title', 'author', 'pages', 'publisher')
+    for op, direction in (('>', 'ASC'), ('<', 'DESC'))
+]
+
+
+def schema_version(conn):
+    """Текущая версия схемы (0, если миграции еще не применялись)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def apply_migrations(conn):
+    """Применяет по порядку все миграции новее текущей версии схемы.
+    Каждая миграция выполняется в отдельной транзакции."""
+    current = schema_version(conn)
+    conn.commit()
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            conn.execute("BEGIN")
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, datetime.now().isoformat(timespec='seconds'))
+            )
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+def check_query_plans(conn):
+    """Прогоняет EXPLAIN QUERY PLAN по INDEX_QUERIES.
+    Возвращает список (запрос, план) для запросов, которые читают
+    таблицу полным сканированием без индекса или сортируют результат
+    во временном B-дереве."""
+    problems = []
+    for query, params in INDEX_QUERIES:
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+        if any((step.startswith('SCAN') and 'INDEX' not in step) or 'TEMP B-TREE' in step for step in plan):
+            problems.append((query, plan))
+    return problems
@@ -0,0 +1,47 @@
+import re
+
+# Полнотекстовый поиск по каталогу (SQLite FTS5, таблица books_fts).
+# Регистр для кириллицы сворачивает токенизатор unicode61, а "ё" -> "е"
+# делается и при индексации (в триггерах), и здесь при разборе запроса.
+
+# Веса столбцов для bm25: совпадение в названии важнее автора и издательства
+BM25_WEIGHTS = (10.0, 5.0, 1.0)
+
+# Окончания русских слов, от длинных к коротким (облегченный стеммер)
+_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'иях', 'ией',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ом', 'ем',
+    'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ию', 'ья', 'ье', 'ьи', 'ью', 'ия',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+_MIN_STEM = 3
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fold(text):
+    """Нормализация текста перед поиском: нижний регистр и ё -> е"""
+    return text.lower().replace('ё', 'е')
+
+
+def stem(word):
+    """Отбрасывает типичное окончание, чтобы искать все формы слова префиксом"""
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def build_match(q):
+    """Строит выражение MATCH для FTS5 или None, если в запросе нет слов.
+    Каждое слово ищется как префикс своей основы: "дюны" -> "дюн"*"""
+    terms = [stem(token) for token in _TOKEN_RE.findall(fold(q or ''))]
+    if not terms:
+        return None
+    # Кавычки экранируют операторы FTS5 (AND, NEAR, * и т.п.) в пользовательском вводе
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def bm25_expr():
+    weights = ', '.join(str(w) for w in BM25_WEIGHTS)
+    return f"bm25(books_fts, {weights})"
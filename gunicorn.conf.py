@@ -0,0 +1,40 @@
+"""Настройки gunicorn: pre-fork воркеры по числу ядер.
+
+Переменные окружения: BIND, WEB_CONCURRENCY (воркеров), WEB_THREADS
+(потоков на воркер), MAX_REQUESTS, GRACEFUL_TIMEOUT, TIMEOUT, METRICS_DIR
+(общие метрики воркеров, очищается при старте).
+"""
+import glob
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+
+# Запросы каталога упираются в CPU (SQLite, шаблоны), поэтому воркер на ядро.
+# WEB_THREADS > 1 включает gthread-воркеры; по умолчанию sync: в gunicorn 21
+# gthread-воркер при перезапуске по max_requests обрывает уже принятые соединения
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('WEB_THREADS', 1))
+
+# Приложение импортируется один раз в мастере, воркеры получают его через
+# fork. Соединения с базой, пулы хэширования и миниатюр создаются лениво
+# уже в воркере (они проверяют pid), поэтому общим ничего не становится.
+preload_app = True
+
+# Плавный перезапуск воркеров: после max_requests (с разбросом, чтобы не
+# все сразу) воркер дообслуживает текущие запросы и заменяется новым
+max_requests = int(os.environ.get('MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('TIMEOUT', 60))
+keepalive = 5
+
+accesslog = os.environ.get('ACCESS_LOG')  # '-' - в stdout; по умолчанию выключен
+
+
+def on_starting(server):
+    # Снимки метрик воркеров (METRICS_DIR) прошлого запуска сервера не суммируются с новыми
+    metrics_dir = os.environ.get('METRICS_DIR')
+    if metrics_dir:
+        for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+            os.remove(path)
@@ -1,14 +1,22 @@
-from flask import Blueprint, request, render_template, session, redirect, url_for, flash
+from flask import Blueprint, request, render_template, session, redirect, url_for, flash, Response, stream_with_context
 from db.database import db_connect, db_close
+from db.catalog import catalog_generation
+from db.facets import facets_changed
+from db.bulk import read_rows, import_books as bulk_import, export_books as bulk_export, FORMATS
+from db.maintenance import schedule_maintenance
+from services.images import UPLOAD_FOLDER, schedule_renditions
+from services import covers, jobs
+from services.metrics import timed
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 import os
-from datetime import datetime
+import logging
+import click
 
 admin_bp = Blueprint('admin', __name__)
+logger = logging.getLogger(__name__)
 
-# Настройки для загрузки файлов
-UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 
-                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'pic'))
+# Настройки для загрузки файлов (папка обложек задается в services.images)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
 # Создаем папку если её нет
@@ -17,25 +25,47 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 def allowed_file(filename):
     result = '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-    print(f"Allowed file check: {filename} -> {result}")  # Отладка
+    logger.debug("upload allowed_check filename=%s allowed=%s", filename, result)
     return result
 
-def generate_unique_filename(filename):
-    """Генерирует уникальное имя файла с timestamp"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    
-    # Получаем расширение из оригинального имени
-    original_ext = os.path.splitext(filename)[1].lower()
-    
-    # Проверяем что расширение допустимое, иначе используем .jpg
-    if not original_ext or original_ext[1:] not in ALLOWED_EXTENSIONS:
-        original_ext = '.jpg'
-    
-    # Генерируем случайное имя + timestamp
-    import uuid
-    random_name = str(uuid.uuid4())[:8]  # первые 8 символов UUID
-    print(f"book_{random_name}_{timestamp}{original_ext}")
-    return f"book_{random_name}_{timestamp}{original_ext}"
+def save_cover(file):
+    """Сохраняет загруженную обложку (имя файла - хэш содержимого, одинаковые
+    файлы не дублируются). Возвращает имя или None, если файл отклонен."""
+    try:
+        with timed('file_io'):
+            filename, created = covers.store(file.stream)
+    except covers.CoverError as e:
+        logger.debug("upload rejected filename=%s reason=%s", file.filename, e)
+        flash(str(e), 'error')
+        return None
+    except OSError as e:
+        logger.exception("upload failed filename=%s", file.filename)
+        flash(f'Ошибка при сохранении файла: {str(e)}', 'error')
+        return None
+    logger.debug("upload stored filename=%s created=%s", filename, created)
+    return filename
+
+def cover_changed(cur, new=None, old=None):
+    """Побочная работа после смены обложки - в очередь задач, в той же
+    транзакции, что и запись книги: миниатюры новой обложки и удаление
+    старой, если на нее больше никто не ссылается"""
+    if new and new != covers.DEFAULT_COVER:
+        schedule_renditions(cur, new)
+    if old:
+        covers.schedule_collect(cur, [old])
+
+def cover_too_large(template, **context):
+    """Ответ 413, если тело запроса больше лимита обложки: по Content-Length
+    до разбора формы, а для chunked-тела - как только при разборе
+    превышен предел (covers.UploadRequest)"""
+    try:
+        if not covers.upload_too_large(request.content_length):
+            request.files
+            return None
+    except RequestEntityTooLarge:
+        pass
+    flash(f'Файл обложки больше {covers.MAX_COVER_SIZE // (1024 * 1024)} МБ', 'error')
+    return render_template(template, **context), 413
 
 @admin_bp.route('/add_book', methods=['GET', 'POST'])
 def add_book():
@@ -44,11 +74,30 @@ def add_book():
         return redirect(url_for('main.index'))
     
     if request.method == 'POST':
+        too_large = cover_too_large('add_book.html')
+        if too_large:
+            return too_large
+        
         title = request.form.get('title', '').strip()
         author = request.form.get('author', '').strip()
         pages = request.form.get('pages', '').strip()
         publisher = request.form.get('publisher', '').strip()
         
+        # Поля проверяются до записи обложки на диск, чтобы отклоненная
+        # форма не оставляла файлов без книги
+        if not all([title, author, pages, publisher]):
+            flash('Все обязательные поля должны быть заполнены', 'error')
+            return render_template('add_book.html')
+        
+        # Валидация числовых полей
+        try:
+            pages_int = int(pages)
+            if pages_int <= 0:
+                raise ValueError("Pages must be positive")
+        except (ValueError, TypeError):
+            flash('Количество страниц должно быть положительным числом', 'error')
+            return render_template('add_book.html')
+        
         # Значение по умолчанию для обложки
         cover_image = 'default_cover.jpg'
         
@@ -71,72 +120,32 @@ def add_book():
             # Обработка загруженного файла
             if 'cover_image' in request.files:
                 file = request.files['cover_image']
-                print(f"File received: {file}")  # Отладка
-                print(f"File filename: {file.filename}")  # Отладка
-                print(f"File content type: {file.content_type}")  # Отладка
+                logger.debug("upload received filename=%s content_type=%s", file.filename, file.content_type)
                 
                 # Проверяем что файл действительно загружен и имеет допустимое расширение
                 if file and file.filename and file.filename != '':
-                    print(f"File is not empty, checking extension...")  # Отладка
-                    
                     if allowed_file(file.filename):
-                        print(f"File extension is allowed")  # Отладка
-                        
-                        filename = generate_unique_filename(file.filename)
-                        file_path = os.path.join(UPLOAD_FOLDER, filename)
-                        
-                        print(f"Attempting to save to: {file_path}")  # Отладка
-                        print(f"Upload folder: {UPLOAD_FOLDER}")  # Отладка
-                        print(f"Full path exists: {os.path.exists(file_path)}")  # Отладка
-                        
-                        # Сохраняем файл
-                        try:
-                            file.save(file_path)
-                            print(f"File save attempted, checking if exists...")  # Отладка
-                            
-                            # Проверяем что файл действительно сохранился
-                            if os.path.exists(file_path):
-                                file_size = os.path.getsize(file_path)
-                                print(f"File successfully saved! Size: {file_size} bytes")  # Отладка
-                                cover_image = filename
-                                flash('Обложка успешно загружена!', 'success')
-                            else:
-                                print("ERROR: File was not saved!")  # Отладка
-                                flash('Ошибка: файл не был сохранен на сервере', 'error')
-                                
-                        except Exception as e:
-                            print(f"ERROR during file save: {e}")  # Отладка
-                            flash(f'Ошибка при сохранении файла: {str(e)}', 'error')
-                            
+                        # Файл пишется на диск потоком с подсчетом хэша
+                        filename = save_cover(file)
+                        if filename:
+                            cover_image = filename
+                            flash('Обложка успешно загружена!', 'success')
                     else:
-                        print(f"File extension not allowed: {file.filename}")  # Отладка
+                        logger.debug("upload rejected filename=%s", file.filename)
                         flash('Недопустимый формат файла. Используйте JPG, PNG или GIF.', 'error')
                 else:
-                    print("File is empty or no filename")  # Отладка
-            
-            # Валидация обязательных полей
-            if not all([title, author, pages, publisher]):
-                flash('Все обязательные поля должны быть заполнены', 'error')
-                db_close(conn, cur)
-                return render_template('add_book.html')
-            
-            # Валидация числовых полей
-            try:
-                pages_int = int(pages)
-                if pages_int <= 0:
-                    raise ValueError("Pages must be positive")
-            except (ValueError, TypeError):
-                flash('Количество страниц должно быть положительным числом', 'error')
-                db_close(conn, cur)
-                return render_template('add_book.html')
+                    logger.debug("upload empty")
             
             # Добавляем книгу в БД
             cur.execute(
                 "INSERT INTO books (title, author, pages, publisher, cover_image) VALUES (?, ?, ?, ?, ?)",
                 (title, author, pages_int, publisher, cover_image)
             )
+            cover_changed(cur, new=cover_image)
             
+            generation = catalog_generation(cur)
             db_close(conn, cur)
+            facets_changed(generation, new={'author': author, 'publisher': publisher})
             flash('Книга успешно добавлена!', 'success')
             return redirect(url_for('main.index'))
             
@@ -165,11 +174,29 @@ def edit_book(book_id):
             return redirect(url_for('main.index'))
         
         if request.method == 'POST':
+            too_large = cover_too_large('edit_book.html', book=book)
+            if too_large:
+                return too_large
+            
             title = request.form.get('title', '').strip()
             author = request.form.get('author', '').strip()
             pages = request.form.get('pages', '').strip()
             publisher = request.form.get('publisher', '').strip()
             
+            # Поля проверяются до записи новой обложки на диск
+            if not all([title, author, pages, publisher]):
+                flash('Все обязательные поля должны быть заполнены', 'error')
+                return render_template('edit_book.html', book=book)
+            
+            # Валидация числовых полей
+            try:
+                pages_int = int(pages)
+                if pages_int <= 0:
+                    raise ValueError("Pages must be positive")
+            except (ValueError, TypeError):
+                flash('Количество страниц должно быть положительным числом', 'error')
+                return render_template('edit_book.html', book=book)
+            
             # По умолчанию оставляем текущую обложку
             cover_image = book['cover_image']
             
@@ -190,38 +217,28 @@ def edit_book(book_id):
                 # Проверяем что файл действительно загружен
                 if file and file.filename and file.filename != '':
                     if allowed_file(file.filename):
-                        filename = generate_unique_filename(file.filename)
-                        file_path = os.path.join(UPLOAD_FOLDER, filename)
-                        
                         # Сохраняем новый файл
-                        file.save(file_path)
+                        filename = save_cover(file)
+                        if not filename:
+                            return render_template('edit_book.html', book=book)
                         cover_image = filename
                         flash('Новая обложка успешно загружена!', 'success')
                     else:
                         flash('Недопустимый формат файла. Используйте JPG, PNG или GIF.', 'error')
                         return render_template('edit_book.html', book=book)
             
-            # Валидация обязательных полей
-            if not all([title, author, pages, publisher]):
-                flash('Все обязательные поля должны быть заполнены', 'error')
-                return render_template('edit_book.html', book=book)
-            
-            # Валидация числовых полей
-            try:
-                pages_int = int(pages)
-                if pages_int <= 0:
-                    raise ValueError("Pages must be positive")
-            except (ValueError, TypeError):
-                flash('Количество страниц должно быть положительным числом', 'error')
-                return render_template('edit_book.html', book=book)
-            
             # Обновляем книгу в БД
             cur.execute(
                 "UPDATE books SET title = ?, author = ?, pages = ?, publisher = ?, cover_image = ? WHERE id = ?",
                 (title, author, pages_int, publisher, cover_image, book_id)
             )
+            if cover_image != book['cover_image']:
+                # Старая обложка могла остаться без книг
+                cover_changed(cur, new=cover_image, old=book['cover_image'])
             
+            generation = catalog_generation(cur)
             db_close(conn, cur)
+            facets_changed(generation, old=book, new={'author': author, 'publisher': publisher})
             flash('Книга успешно обновлена!', 'success')
             return redirect(url_for('main.index'))
         
@@ -243,18 +260,135 @@ def delete_book(book_id):
     conn, cur = db_connect()
     
     # Проверяем существование книги
-    cur.execute("SELECT id FROM books WHERE id = ?", (book_id,))
-    if not cur.fetchone():
+    cur.execute("SELECT author, publisher, cover_image FROM books WHERE id = ?", (book_id,))
+    book = cur.fetchone()
+    if not book:
         flash('Книга не найдена', 'error')
         db_close(conn, cur)
         return redirect(url_for('main.index'))
     
     try:
         cur.execute("DELETE FROM books WHERE id = ?", (book_id,))
+        cover_changed(cur, old=book['cover_image'])
+        generation = catalog_generation(cur)
         db_close(conn, cur)
+        facets_changed(generation, old=book)
         flash('Книга успешно удалена!', 'success')
     except Exception as e:
         db_close(conn, cur)
         flash(f'Ошибка базы данных: {str(e)}', 'error')
     
-    return redirect(url_for('main.index'))
\ No newline at end of file
+    return redirect(url_for('main.index'))
+
+# ОЧЕРЕДЬ ФОНОВЫХ ЗАДАЧ
+@admin_bp.route('/admin/jobs')
+def jobs_status():
+    if not session.get('is_admin'):
+        flash('Доступ запрещен', 'error')
+        return redirect(url_for('main.index'))
+    
+    status = request.args.get('status')
+    if status not in jobs.STATUSES:
+        status = None
+    conn, cur = db_connect(readonly=True)
+    counts = jobs.summary(cur)
+    rows = jobs.recent(cur, status)
+    db_close(conn, cur)
+    return render_template('admin_jobs.html', counts=counts, jobs=rows, status=status)
+
+@admin_bp.route('/admin/jobs/<int:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    if not session.get('is_admin'):
+        flash('Доступ запрещен', 'error')
+        return redirect(url_for('main.index'))
+    
+    conn, cur = db_connect()
+    if jobs.retry(cur, job_id):
+        flash('Задача возвращена в очередь', 'success')
+    else:
+        flash('Задача не найдена или не завершилась ошибкой', 'error')
+    db_close(conn, cur)
+    return redirect(url_for('admin.jobs_status', status='failed'))
+
+def detect_format(filename):
+    ext = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    return 'jsonl' if ext in ('jsonl', 'json') else 'csv'
+
+# МАССОВЫЙ ИМПОРТ И ЭКСПОРТ
+@admin_bp.route('/admin/import', methods=['GET', 'POST'])
+def import_books():
+    if not session.get('is_admin'):
+        flash('Доступ запрещен', 'error')
+        return redirect(url_for('main.index'))
+    
+    if request.method == 'POST':
+        file = request.files.get('books_file')
+        if not file or not file.filename:
+            flash('Выберите файл для импорта', 'error')
+            return render_template('import_books.html')
+        
+        conn, cur = db_connect()
+        try:
+            # Файл читается потоком, книги пишутся пачками
+            stats = bulk_import(conn, read_rows(file.stream, detect_format(file.filename)))
+            # Статистика планировщика после большой заливки - фоном
+            schedule_maintenance(cur)
+            db_close(conn, cur)
+            flash(f"Импортировано строк: {stats['processed']}, пропущено некорректных: {stats['skipped']}", 'success')
+            return redirect(url_for('main.index'))
+        except Exception as e:
+            db_close(conn, cur)
+            flash(f'Ошибка импорта: {str(e)}', 'error')
+    
+    return render_template('import_books.html')
+
+@admin_bp.route('/admin/export')
+def export_books():
+    if not session.get('is_admin'):
+        flash('Доступ запрещен', 'error')
+        return redirect(url_for('main.index'))
+    
+    fmt = request.args.get('format', 'csv')
+    if fmt not in FORMATS:
+        flash('Неизвестный формат экспорта', 'error')
+        return redirect(url_for('admin.import_books'))
+    
+    conn, cur = db_connect(readonly=True)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    # Ответ отдается по мере чтения курсора, без сборки файла в памяти
+    return Response(stream_with_context(bulk_export(conn, fmt)),
+                    mimetype=f'{mimetype}; charset=utf-8',
+                    headers={'Content-Disposition': f'attachment; filename=books.{fmt}'})
+
+@admin_bp.cli.command('import-books')
+@click.argument('path', type=click.File('rb'))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help='По умолчанию - по расширению файла')
+@click.option('--batch-size', default=5000, show_default=True)
+def import_books_command(path, fmt, batch_size):
+    """Импорт книг из CSV/JSONL (дубликаты обновляются)"""
+    conn, cur = db_connect()
+    progress = lambda stats: click.echo(f"\rЗагружено: {stats['processed']}", nl=False, err=True)
+    stats = bulk_import(conn, read_rows(path, fmt or detect_format(path.name)),
+                        batch_size=batch_size, progress=progress)
+    db_close(conn, cur)
+    click.echo(f"\nГотово: {stats['processed']} строк, пропущено {stats['skipped']}, пачек {stats['batches']}", err=True)
+
+@admin_bp.cli.command('export-books')
+@click.argument('path', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='csv', show_default=True)
+def export_books_command(path, fmt):
+    """Экспорт всех книг в CSV/JSONL (по умолчанию в stdout)"""
+    conn, cur = db_connect(readonly=True)
+    for chunk in bulk_export(conn, fmt):
+        path.write(chunk)
+    db_close(conn, cur)
+
+@admin_bp.cli.command('gc-covers')
+@click.option('--grace', type=float, default=covers.COVER_GC_GRACE, show_default=True,
+              help='Не трогать файлы моложе стольких секунд')
+def gc_covers_command(grace):
+    """Удаляет файлы обложек, на которые не ссылается ни одна книга"""
+    conn, cur = db_connect()
+    stats = covers.collect(conn, grace=grace)
+    db_close(conn, cur)
+    click.echo(f"Удалено файлов: {stats['removed']}, освобождено байт: {stats['bytes']}", err=True)
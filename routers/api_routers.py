@@ -0,0 +1,131 @@
+import json
+from flask import Blueprint, request, Response, jsonify, stream_with_context
+from db.database import db_connect, db_close
+from db.catalog import (filters_from_args, validate_filters, normalize_sort, fetch_page, iter_books,
+                        encode_cursor, InvalidQuery, SORT_FIELDS, SORT_ORDERS, SEARCH_SORT_FIELD)
+from db.facets import get_facets, FACETS
+from db.search import build_match
+
+api_bp = Blueprint('api', __name__, url_prefix='/api')
+
+# Поля книги, доступные через API (fields=title,author)
+API_FIELDS = ('id', 'title', 'author', 'pages', 'publisher', 'cover_image')
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+SUGGEST_LIMIT = 20
+
+_dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+
+def api_error(message, status=400):
+    return jsonify({'error': message}), status
+
+
+def _parse_fields(value):
+    if not value:
+        return list(API_FIELDS)
+    fields = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in fields if name not in API_FIELDS]
+    if unknown or not fields:
+        return None
+    return list(dict.fromkeys(fields))
+
+
+def _row_dict(row, fields):
+    return {name: row[name] for name in fields}
+
+
+@api_bp.route('/books')
+def books():
+    """Каталог книг в JSON/NDJSON с теми же фильтрами и сортировками, что и главная.
+
+    fields=title,author - какие поля вернуть (читаются только они);
+    limit - размер страницы, after - токен продолжения из ответа;
+    format=ndjson без limit отдает потоком все подходящие книги."""
+    filters = filters_from_args(request.args)
+    search = build_match(filters['q']) is not None
+
+    sort_field = request.args.get('sort_field', '')
+    sort_order = request.args.get('sort_order', 'asc')
+    if sort_field and sort_field not in SORT_FIELDS and sort_field != SEARCH_SORT_FIELD:
+        return api_error(f"Неизвестное поле сортировки: {sort_field}")
+    if sort_order not in SORT_ORDERS:
+        return api_error(f"Неизвестный порядок сортировки: {sort_order}")
+    sort_field, sort_order = normalize_sort(sort_field, sort_order, search=search)
+
+    fields = _parse_fields(request.args.get('fields'))
+    if fields is None:
+        return api_error(f"Допустимые поля: {', '.join(API_FIELDS)}")
+
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'ndjson'):
+        return api_error("format должен быть json или ndjson")
+
+    limit = request.args.get('limit', type=int)
+    if limit is not None and not 1 <= limit <= MAX_LIMIT:
+        return api_error(f"limit должен быть от 1 до {MAX_LIMIT}")
+    after = request.args.get('after')
+
+    try:
+        validate_filters(filters)
+    except InvalidQuery as e:
+        return api_error(str(e))
+
+    conn, cur = db_connect(readonly=True)
+
+    if fmt == 'ndjson' and limit is None:
+        # Полная выгрузка: строки идут потоком порциями по курсору
+        rows = iter_books(cur, filters, sort_field, sort_order, columns=fields, after=after)
+        body = (_dumps(_row_dict(row, fields)) + '\n' for row in rows)
+        return Response(stream_with_context(body), mimetype='application/x-ndjson')
+
+    books, has_next, _, _ = fetch_page(cur, filters, sort_field, sort_order, limit or DEFAULT_LIMIT,
+                                       after=after, columns=fields)
+
+    next_token = encode_cursor(books[-1], sort_field, sort_order) if books and has_next else None
+
+    if fmt == 'ndjson':
+        # Токен продолжения - в заголовке, тело - только строки
+        body = ''.join(_dumps(_row_dict(row, fields)) + '\n' for row in books)
+        response = Response(body, mimetype='application/x-ndjson')
+        if next_token:
+            response.headers['X-Next-Cursor'] = next_token
+        return response
+
+    def generate():
+        yield '{"items":['
+        for i, row in enumerate(books):
+            yield (',' if i else '') + _dumps(_row_dict(row, fields))
+        yield '],"next":' + _dumps(next_token) + '}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+@api_bp.route('/facets/<facet>')
+def facet_suggest(facet):
+    """Подсказки для ввода автора/издательства: q - начало или часть
+    значения (без учета регистра), сначала совпадения с начала строки.
+    Ищет по кэшу фасетов процесса, без запросов к books."""
+    if facet not in FACETS:
+        return api_error(f"Неизвестный фасет: {facet}", 404)
+    limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+    if not 1 <= limit <= MAX_LIMIT:
+        return api_error(f"limit должен быть от 1 до {MAX_LIMIT}")
+    query = request.args.get('q', '').strip().casefold()
+
+    conn, cur = db_connect(readonly=True)
+    authors, publishers = get_facets(cur)
+    db_close(conn, cur)
+    items = authors if facet == 'author' else publishers
+
+    prefix, contains = [], []
+    for value, count in items:
+        folded = value.casefold()
+        if folded.startswith(query):
+            prefix.append((value, count))
+            if len(prefix) >= limit:
+                break
+        elif query in folded and len(contains) < limit:
+            contains.append((value, count))
+    matches = (prefix + contains)[:limit]
+    return jsonify({'items': [{'value': value, 'count': count} for value, count in matches]})
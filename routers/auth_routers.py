@@ -1,22 +1,42 @@
 from flask import Blueprint, request, session, redirect, url_for, flash, render_template
-from werkzeug.security import generate_password_hash, check_password_hash
 from db.database import db_connect, db_close
+from services.hashing import hash_password, verify_password, needs_rehash, HashingBusy
 import sqlite3
 
 auth_bp = Blueprint('auth', __name__)
 
+def hashing_busy(template, action):
+    """Пул хэширования перегружен: отвечаем сразу, не занимая поток запроса"""
+    flash(f'Сервер перегружен, попробуйте {action} через несколько секунд', 'error')
+    return render_template(template), 503, {'Retry-After': '1'}
+
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
         
-        conn, cur = db_connect()
+        conn, cur = db_connect(readonly=True)
         cur.execute("SELECT * FROM users WHERE username = ?", (username,))
         user = cur.fetchone()
         db_close(conn, cur)
         
-        if user and check_password_hash(user['password_hash'], password):
+        try:
+            valid = bool(user) and verify_password(user['password_hash'], password)
+        except HashingBusy:
+            return hashing_busy('login.html', 'войти')
+        
+        if valid:
+            # Хэш со старыми параметрами прозрачно пересчитываем при входе
+            if needs_rehash(user['password_hash']):
+                try:
+                    new_hash = hash_password(password)
+                    conn, cur = db_connect()
+                    cur.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_hash, user['id']))
+                    db_close(conn, cur)
+                except (HashingBusy, sqlite3.Error):
+                    pass  # Обновим при следующем входе
+            
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['is_admin'] = bool(user['is_admin'])
@@ -38,14 +58,21 @@ def register():
             flash('Логин может содержать только латинские буквы, цифры и символы ._-', 'error')
             return render_template('register.html')
         
-        conn, cur = db_connect()
+        conn, cur = db_connect(readonly=True)
         cur.execute("SELECT id FROM users WHERE username = ?", (username,))
-        if cur.fetchone():
+        exists = cur.fetchone()
+        db_close(conn, cur)
+        if exists:
             flash('Пользователь с таким логином уже существует', 'error')
-            db_close(conn, cur)
             return render_template('register.html')
         
-        password_hash = generate_password_hash(password)
+        # Хэшируем в пуле процессов, не держа открытой транзакцию
+        try:
+            password_hash = hash_password(password)
+        except HashingBusy:
+            return hashing_busy('register.html', 'зарегистрироваться')
+        
+        conn, cur = db_connect()
         try:
             cur.execute(
                 "INSERT INTO users (username, password_hash, is_admin) VALUES (?, ?, ?)",
@@ -54,6 +81,8 @@ def register():
             db_close(conn, cur)
             flash('Регистрация успешна! Теперь войдите.', 'success')
             return redirect(url_for('auth.login'))
+        except sqlite3.IntegrityError:
+            flash('Пользователь с таким логином уже существует', 'error')
         except sqlite3.Error:
             flash('Ошибка базы данных', 'error')
     
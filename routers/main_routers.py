@@ -1,96 +1,109 @@
-from flask import Blueprint, request, render_template, session, redirect, url_for, flash
+from flask import Blueprint, request, render_template, session, redirect, url_for, flash, abort, make_response
 from db.database import db_connect, db_close
+from db.catalog import (filters_from_args, validate_filters, normalize_sort, fetch_page, count_books,
+                        encode_cursor, catalog_generation, InvalidQuery)
+from db.facets import get_facets
+from db.search import build_match
+from services.page_cache import cached_page, cached_fragment, ROW_SIZE_ESTIMATE
+from services.fragments import facet_options as render_facet_options, facet_select, is_lazy_facet
 
 main_bp = Blueprint('main', __name__)
 
 @main_bp.route('/')
+@cached_page
 def index():
     # Получаем параметры из GET запроса
     page = request.args.get('page', 1, type=int)
-    sort_field = request.args.get('sort_field', 'title')
-    sort_order = request.args.get('sort_order', 'asc')
+    after = request.args.get('after')
+    before = request.args.get('before')
     
     # Фильтры из GET параметров
-    filters = {
-        'title': request.args.get('title', ''),
-        'author': request.args.get('author', ''),
-        'publisher': request.args.get('publisher', ''),
-        'pages_min': request.args.get('pages_min', ''),
-        'pages_max': request.args.get('pages_max', '')
-    }
+    filters = filters_from_args(request.args)
+    # Некорректные параметры отклоняются до обращения к базе
+    try:
+        validate_filters(filters)
+    except InvalidQuery as e:
+        abort(400, description=str(e))
+    
+    # При полнотекстовом поиске по умолчанию сортируем по релевантности
+    search = build_match(filters['q']) is not None
+    sort_field, sort_order = normalize_sort(request.args.get('sort_field', ''),
+                                            request.args.get('sort_order', 'asc'),
+                                            search=search)
     
     per_page = 21
     
-    # Получаем уникальных авторов и издателей из БД
-    conn, cur = db_connect()
-    
-    # Уникальные авторы
-    cur.execute("SELECT DISTINCT author FROM books ORDER BY author")
-    authors = [row['author'] for row in cur.fetchall()]
-    
-    # Уникальные издательства
-    cur.execute("SELECT DISTINCT publisher FROM books ORDER BY publisher")
-    publishers = [row['publisher'] for row in cur.fetchall()]
-    
-    # Построение SQL запроса для книг
-    where_conditions = []
-    query_params = []
-    
-    if filters['title']:
-        where_conditions.append("title LIKE ?")
-        query_params.append(f"%{filters['title']}%")
-    
-    if filters['author']:
-        where_conditions.append("author = ?")  # Точное совпадение для выпадающего списка
-        query_params.append(filters['author'])
-    
-    if filters['publisher']:
-        where_conditions.append("publisher = ?")  # Точное совпадение для выпадающего списка
-        query_params.append(filters['publisher'])
-    
-    if filters['pages_min']:
-        where_conditions.append("pages >= ?")
-        query_params.append(int(filters['pages_min']))
-    
-    if filters['pages_max']:
-        where_conditions.append("pages <= ?")
-        query_params.append(int(filters['pages_max']))
-    
-    where_clause = ""
-    if where_conditions:
-        where_clause = "WHERE " + " AND ".join(where_conditions)
-    
-    # Подсчет общего количества
-    count_query = f"SELECT COUNT(*) as total FROM books {where_clause}"
-    cur.execute(count_query, query_params)
-    total_count = cur.fetchone()['total']
-    
-    # Получение книг с пагинацией
-    offset = (page - 1) * per_page
-    order_clause = f"ORDER BY {sort_field} {sort_order.upper()}"
-    
-    books_query = f"""
-        SELECT * FROM books 
-        {where_clause} 
-        {order_clause} 
-        LIMIT ? OFFSET ?
-    """
-    
-    query_params.extend([per_page, offset])
-    cur.execute(books_query, query_params)
-    books = cur.fetchall()
+    # Получаем уникальных авторов и издателей из БД (только чтение)
+    conn, cur = db_connect(readonly=True)
+    generation = catalog_generation(cur)
+    
+    # Авторы и издательства с количеством книг - из кэша фасетов,
+    # пересчитываются только после изменений каталога; готовые <option>
+    # тоже кэшируются, на каждый запрос отмечается только выбранный
+    authors, publishers = get_facets(cur, generation)
+    author_options = facet_select('author', authors, generation, filters['author'], 'Все авторы')
+    publisher_options = facet_select('publisher', publishers, generation, filters['publisher'],
+                                     'Все издательства')
+    
+    def load_books():
+        # Получение книг: курсорная пагинация (after/before) или старый ?page=.
+        # has_next определяется выборкой per_page + 1 строк, без подсчета
+        books, has_next, has_prev, by_cursor = fetch_page(cur, filters, sort_field, sort_order, per_page,
+                                                          after=after, before=before, page=page)
+        
+        # Общее количество нужно только для первой загрузки списка:
+        # "Показать еще" и переходы по курсору его не отображают. Первая
+        # страница (в том числе по ссылке "назад") и выборка по номеру
+        # страницы (в том числе из-за устаревшего курсора) его показывают
+        total_count, count_exact = None, True
+        if not by_cursor or not has_prev:
+            total_count, count_exact = count_books(cur, filters)
+        return books, total_count, count_exact, has_next, has_prev
+    
+    # Результаты запросов кэшируются по параметрам и поколению каталога
+    books, total_count, count_exact, has_next, has_prev = cached_fragment(
+        'index.books', generation, load_books,
+        size=lambda value: ROW_SIZE_ESTIMATE * (len(value[0]) + 1))
     
     db_close(conn, cur)
     
-    has_next = (page * per_page) < total_count
+    next_cursor = encode_cursor(books[-1], sort_field, sort_order) if books and has_next else None
+    prev_cursor = encode_cursor(books[0], sort_field, sort_order) if books and has_prev else None
     
     return render_template('index.html', 
                          books=books,
                          current_page=page,
                          total_count=total_count,
+                         count_exact=count_exact,
                          has_next=has_next,
+                         has_prev=has_prev,
+                         next_cursor=next_cursor,
+                         prev_cursor=prev_cursor,
                          sort_field=sort_field,
                          sort_order=sort_order,
+                         search=search,
                          filters=filters,
-                         authors=authors,
-                         publishers=publishers)
\ No newline at end of file
+                         generation=generation,
+                         author_options=author_options,
+                         publisher_options=publisher_options,
+                         lazy_authors=is_lazy_facet(authors),
+                         lazy_publishers=is_lazy_facet(publishers))
+
+
+@main_bp.route('/facets/<facet>')
+def facet_options(facet):
+    """Все <option> фасета для длинных выпадающих списков. Ответ зависит
+    только от поколения каталога, поэтому браузер перепроверяет его по ETag."""
+    if facet not in ('author', 'publisher'):
+        abort(404)
+    conn, cur = db_connect(readonly=True)
+    generation = catalog_generation(cur)
+    authors, publishers = get_facets(cur, generation)
+    db_close(conn, cur)
+
+    items = authors if facet == 'author' else publishers
+    response = make_response(render_facet_options(facet, items, generation))
+    response.set_etag(f"{facet}-{generation}")
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
\ No newline at end of file
@@ -0,0 +1,161 @@
+import gzip
+import mimetypes
+import os
+import re
+import threading
+import time
+from flask import current_app, request, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from services.images import content_hash
+
+# Отпечаток содержимого в URL (?v=...) позволяет кэшировать файл навсегда:
+# новое содержимое - новый URL
+STATIC_MAX_AGE = 365 * 24 * 3600
+# Без отпечатка (старые ссылки) браузер перепроверяет файл (ETag/304)
+STATIC_REVALIDATE_MAX_AGE = int(os.environ.get('STATIC_REVALIDATE_MAX_AGE', 0))
+# Как часто перепроверять mtime файла для отпечатка, секунды
+FINGERPRINT_CHECK_INTERVAL = float(os.environ.get('FINGERPRINT_CHECK_INTERVAL', 2.0))
+
+# Имена, которые сами являются хэшем содержимого (обложки и миниатюры) -
+# их содержимое по определению не меняется
+IMMUTABLE_NAME = re.compile(r'^[0-9a-f]{20,64}(-\d+)?\.\w+$')
+
+# Что имеет смысл сжимать заранее; картинки уже сжаты
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.txt', '.json', '.html', '.xml', '.map'}
+# Варианты в порядке предпочтения: (Content-Encoding, суффикс файла)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_fingerprints = {}  # путь -> (проверено, mtime_ns, отпечаток)
+_lock = threading.Lock()
+
+
+def is_immutable(filename):
+    return bool(IMMUTABLE_NAME.match(os.path.basename(filename)))
+
+
+def fingerprint(folder, filename):
+    """Короткий хэш содержимого статического файла или None, если файла нет.
+    Хэш пересчитывается только при изменении mtime."""
+    path = safe_join(folder, filename)
+    if path is None:
+        return None
+    now = time.monotonic()
+    cached = _fingerprints.get(path)
+    if cached and now - cached[0] < FINGERPRINT_CHECK_INTERVAL:
+        return cached[2]
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    digest = cached[2] if cached and cached[1] == mtime else content_hash(path)[:12]
+    with _lock:
+        _fingerprints[path] = (now, mtime, digest)
+    return digest
+
+
+def _add_fingerprint(endpoint, values):
+    """url_defaults: url_for('static', filename=...) получает ?v=<хэш>"""
+    if endpoint != 'static' or 'v' in values:
+        return
+    filename = values.get('filename')
+    if filename and not is_immutable(filename):
+        digest = fingerprint(current_app.static_folder, filename)
+        if digest:
+            values['v'] = digest
+
+
+def _accepts(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def send_static(filename):
+    """Раздача static/: заранее сжатые варианты (.br/.gz) по Accept-Encoding,
+    вечное кэширование для URL с актуальным отпечатком, условные запросы
+    и Range (send_file), sendfile через wsgi.file_wrapper или X-Sendfile."""
+    folder = current_app.static_folder
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    version = request.args.get('v')
+    immutable = is_immutable(filename) or (version is not None and version == fingerprint(folder, filename))
+
+    served, encoding = filename, None
+    compressible = os.path.splitext(filename)[1].lower() in COMPRESSIBLE_EXTENSIONS
+    if compressible:
+        source_mtime = os.stat(path).st_mtime
+        for name, suffix in ENCODINGS:
+            try:
+                fresh = os.stat(path + suffix).st_mtime >= source_mtime
+            except OSError:
+                continue
+            if fresh and _accepts(name):
+                served, encoding = filename + suffix, name
+                break
+
+    response = send_from_directory(folder, served, conditional=True,
+                                   mimetype=_mimetype(filename),
+                                   max_age=STATIC_MAX_AGE if immutable else STATIC_REVALIDATE_MAX_AGE)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if compressible:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
+def _mimetype(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def _brotli():
+    """brotli - необязательная зависимость: без нее создаются только .gz"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def precompress(folder, progress=None):
+    """Создает рядом с файлами static/ сжатые варианты .gz (и .br, если
+    установлен brotli). Вариант пропускается, если он не меньше исходника.
+    Возвращает число записанных файлов."""
+    brotli = _brotli()
+    written = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE_EXTENSIONS:
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                variants.append(('.br', brotli.compress(data, quality=11)))
+            for suffix, compressed in variants:
+                target = path + suffix
+                if len(compressed) >= len(data):
+                    if os.path.exists(target):
+                        os.remove(target)
+                    continue
+                tmp_path = f"{target}.{os.getpid()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(compressed)
+                os.replace(tmp_path, target)
+                written += 1
+                if progress:
+                    progress(os.path.relpath(target, folder), len(data), len(compressed))
+    return written
+
+
+def init_app(app):
+    # Nginx и подобные могут отдавать файлы сами (заголовок X-Sendfile)
+    app.config.setdefault('USE_X_SENDFILE', os.environ.get('USE_X_SENDFILE') == '1')
+    app.url_defaults(_add_fingerprint)
+    app.view_functions['static'] = send_static
@@ -0,0 +1,199 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from flask import Request
+from db.database import db_connect, db_close
+from services.images import UPLOAD_FOLDER, remove_renditions
+from services.jobs import task, enqueue
+
+# Максимальный размер файла обложки, байты
+MAX_COVER_SIZE = int(os.environ.get('MAX_COVER_SIZE', 5 * 1024 * 1024))
+# Запас на поля формы и разметку multipart сверх самого файла
+FORM_OVERHEAD = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+# Файлы моложе этого возраста (секунды) сборщик мусора не трогает:
+# обложка могла быть только что загружена для книги, которая еще не сохранена
+COVER_GC_GRACE = float(os.environ.get('COVER_GC_GRACE', 300))
+
+DEFAULT_COVER = 'default_cover.jpg'
+# Формат определяется по содержимому, а не по имени файла
+SIGNATURES = ((b'\xff\xd8\xff', '.jpg'), (b'\x89PNG\r\n\x1a\n', '.png'))
+HASHED_NAME = re.compile(r'^[0-9a-f]{32}\.(jpg|png)$')
+TEMP_PREFIX = '.upload-'
+# Формы с файлом обложки; для остальных запросов действует MAX_CONTENT_LENGTH
+UPLOAD_ENDPOINTS = {'admin.add_book', 'admin.edit_book'}
+# Общий предел тела запроса (импорт каталога), байты
+MAX_CONTENT_LENGTH = int(os.environ.get('MAX_CONTENT_LENGTH', 64 * 1024 * 1024))
+
+logger = logging.getLogger(__name__)
+
+
+class CoverError(ValueError):
+    """Загруженный файл нельзя использовать как обложку (текст - для flash)"""
+
+
+def upload_too_large(content_length):
+    """Тело запроса заведомо больше допустимого - проверяется до разбора формы"""
+    return content_length is not None and content_length > MAX_COVER_SIZE + FORM_OVERHEAD
+
+
+class UploadRequest(Request):
+    """Запрос с пределом тела по маршруту: формы обложек ограничены размером
+    обложки. Werkzeug проверяет предел и для тела без Content-Length
+    (chunked) при чтении потока, поэтому такая загрузка не пишется во
+    временный файл целиком."""
+
+    @property
+    def max_content_length(self):
+        if self.endpoint in UPLOAD_ENDPOINTS:
+            return MAX_COVER_SIZE + FORM_OVERHEAD
+        return super().max_content_length
+
+
+def _sniff(head):
+    for signature, ext in SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def store(stream):
+    """Потоково пишет загрузку во временный файл, по пути считая sha256,
+    и переименовывает его в <хэш>.<расширение>. Одинаковые обложки
+    хранятся одним файлом. Возвращает (имя файла, создан ли новый файл)."""
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    ext = None
+    fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=UPLOAD_FOLDER)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if ext is None:
+                    ext = _sniff(chunk)
+                    if ext is None:
+                        raise CoverError('Недопустимый формат файла. Используйте JPG или PNG.')
+                size += len(chunk)
+                if size > MAX_COVER_SIZE:
+                    raise CoverError(f'Файл обложки больше {MAX_COVER_SIZE // (1024 * 1024)} МБ')
+                digest.update(chunk)
+                out.write(chunk)
+        if size == 0:
+            raise CoverError('Файл обложки пустой')
+
+        name = digest.hexdigest()[:32] + ext
+        path = os.path.join(UPLOAD_FOLDER, name)
+        if os.path.exists(path):
+            # Такая обложка уже есть; свежий mtime защищает ее от сборщика мусора
+            os.utime(path)
+            os.remove(tmp_path)
+            logger.debug("cover deduplicated name=%s size=%d", name, size)
+            return name, False
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+        logger.debug("cover stored name=%s size=%d", name, size)
+        return name, True
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _is_old(path, now, grace):
+    try:
+        return os.stat(path).st_mtime < now - grace
+    except FileNotFoundError:
+        return True
+
+
+def _remove_file(name):
+    path = os.path.join(UPLOAD_FOLDER, name)
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        size = 0
+    remove_renditions(name)
+    return size
+
+
+def collect(conn, names=None, grace=COVER_GC_GRACE):
+    """Удаляет файлы обложек, на которые больше не ссылается ни одна книга
+    (cover_refs.refs = 0), вместе с их миниатюрами.
+
+    names - проверить только эти файлы (после правки/удаления книги),
+    иначе полный проход, который заодно убирает файлы с хэш-именем без
+    записи в cover_refs и брошенные временные файлы загрузок."""
+    stats = {'removed': 0, 'bytes': 0}
+    now = time.time()
+    if names is not None:
+        names = [name for name in names if name]
+        if not names:
+            return stats
+
+    conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if names is None:
+            rows = conn.execute("SELECT name FROM cover_refs WHERE refs <= 0").fetchall()
+        else:
+            placeholders = ', '.join('?' * len(names))
+            rows = conn.execute(f"SELECT name FROM cover_refs WHERE refs <= 0 AND name IN ({placeholders})",
+                                names).fetchall()
+        for (name,) in rows:
+            if not HASHED_NAME.match(name):
+                # Обложки из репозитория и старых загрузок (Dune.jpg и т.п.)
+                # store() не создавал - файл остается, убирается только счетчик
+                conn.execute("DELETE FROM cover_refs WHERE name = ? AND refs <= 0", (name,))
+                continue
+            if not _is_old(os.path.join(UPLOAD_FOLDER, name), now, grace):
+                continue
+            conn.execute("DELETE FROM cover_refs WHERE name = ? AND refs <= 0", (name,))
+            stats['bytes'] += _remove_file(name)
+            stats['removed'] += 1
+
+        if names is None and os.path.isdir(UPLOAD_FOLDER):
+            known = {row[0] for row in conn.execute("SELECT name FROM cover_refs")}
+            for entry in os.scandir(UPLOAD_FOLDER):
+                if not entry.is_file():
+                    continue
+                orphan = HASHED_NAME.match(entry.name) and entry.name not in known
+                if (orphan or entry.name.startswith(TEMP_PREFIX)) and _is_old(entry.path, now, grace):
+                    stats['bytes'] += _remove_file(entry.name)
+                    stats['removed'] += 1
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if stats['removed']:
+        logger.info("cover gc removed=%d bytes=%d", stats['removed'], stats['bytes'])
+    return stats
+
+
+@task('covers.collect')
+def collect_task(names):
+    conn, cur = db_connect()
+    try:
+        collect(conn, names)
+    finally:
+        db_close(conn, cur)
+
+
+def schedule_collect(cur, names):
+    """Ставит проверку освободившихся обложек в очередь задач (в транзакции
+    записи книги), чтобы удаление файлов не задерживало запрос"""
+    for name in names:
+        if name and name != DEFAULT_COVER:
+            enqueue(cur, 'covers.collect', {'names': [name]}, key=f"collect:{name}")
+
+
+def init_app(app):
+    app.request_class = UploadRequest
+    app.config.setdefault('MAX_CONTENT_LENGTH', MAX_CONTENT_LENGTH)
@@ -0,0 +1,72 @@
+import os
+from bisect import bisect_left
+from flask import current_app, session, url_for
+from markupsafe import Markup, escape
+from services.images import load_manifest
+from services.page_cache import cached_html
+
+# Если значений фасета больше, список загружается отдельным запросом
+# (/facets/<facet>, кэшируется браузером) при первом открытии выпадающего списка
+FACET_SELECT_LIMIT = int(os.environ.get('FACET_SELECT_LIMIT', 500))
+
+CARD_TEMPLATE = '_book_card.html'
+
+
+def _options_html(items):
+    return Markup(''.join(f'<option value="{escape(value)}">{escape(value)} ({count})</option>'
+                          for value, count in items))
+
+
+def facet_options(facet, items, generation):
+    """Все <option> фасета одной строкой; строятся один раз на поколение каталога"""
+    return cached_html(('facet', facet), generation, lambda: _options_html(items))
+
+
+def facet_select(facet, items, generation, selected, placeholder):
+    """Содержимое <select> фасета с отмеченным выбранным значением.
+
+    Кэшированная строка не зависит от выбора: отметка selected
+    вставляется заменой одного <option>. Для длинных списков
+    отдается только выбранное значение, остальное подгружает браузер."""
+    empty = Markup('<option value="">%s</option>') % placeholder
+    if len(items) > FACET_SELECT_LIMIT:
+        if not selected:
+            return empty
+        i = bisect_left(items, (selected,))
+        count = items[i][1] if i < len(items) and items[i][0] == selected else 0
+        return empty + Markup('<option value="%s" selected>%s (%s)</option>') % (selected, selected, count)
+    options = facet_options(facet, items, generation)
+    if selected:
+        tag = str(Markup('<option value="%s">') % selected)
+        options = Markup(str(options).replace(tag, tag[:-1] + ' selected>', 1))
+    return empty + options
+
+
+def is_lazy_facet(items):
+    return len(items) > FACET_SELECT_LIMIT
+
+
+def book_card(book, generation):
+    """Разметка карточки книги из кэша. Ключ - книга, поколение каталога,
+    роль посетителя (от нее зависят кнопки) и хэш обложки в манифесте
+    (миниатюры достраиваются в фоне, не меняя поколения)."""
+    role = 'admin' if session.get('is_admin') else 'user' if session.get('username') else 'guest'
+    rendition = (load_manifest().get(book['cover_image'] or 'default_cover.jpg') or {}).get('hash')
+    key = ('card', book['id'], role, rendition)
+
+    def render():
+        template = current_app.jinja_env.get_template(CARD_TEMPLATE)
+        # Без render_template: сигналы и контекст-процессоры для каждой карточки не нужны
+        return template.render(book=book, session=session)
+    return cached_html(key, generation, render)
+
+
+def catalog_url(filters, **params):
+    """URL главной с текущими фильтрами; пустые параметры не попадают в ссылку"""
+    values = {name: value for name, value in filters.items() if value}
+    values.update((name, value) for name, value in params.items() if value)
+    return url_for('main.index', **values)
+
+
+def init_app(app):
+    app.jinja_env.globals.update(book_card=book_card, catalog_url=catalog_url)
@@ -0,0 +1,96 @@
+import os
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import lru_cache
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Алгоритм и стоимость хэширования в формате werkzeug:
+# "scrypt:N:r:p" или "pbkdf2:sha256:итерации"
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+
+# Размер пула процессов на веб-воркер (0 - хэшировать прямо в потоке запроса).
+# Пул свой у каждого воркера gunicorn, поэтому по умолчанию ядра делятся
+# между WEB_CONCURRENCY воркерами, а не отдаются каждому целиком
+_CPUS = os.cpu_count() or 1
+HASH_WORKERS = int(os.environ.get(
+    'HASH_WORKERS', max(1, _CPUS // max(1, int(os.environ.get('WEB_CONCURRENCY', _CPUS))))))
+# Сколько задач может ждать в очереди сверх занятых процессов
+HASH_QUEUE_SIZE = int(os.environ.get('HASH_QUEUE_SIZE', HASH_WORKERS * 4))
+# Максимальное время ожидания результата, секунды
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 10))
+
+
+class HashingBusy(Exception):
+    """Очередь хэширования заполнена - запрос нужно отклонить сразу (503)"""
+
+
+_state = {'executor': None, 'pid': None, 'slots': None}
+_lock = threading.Lock()
+
+
+def configure(workers=None, queue_size=None, method=None):
+    """Меняет настройки пула (для бенчмарков и тестов); пул пересоздается лениво"""
+    global HASH_WORKERS, HASH_QUEUE_SIZE, PASSWORD_HASH_METHOD
+    with _lock:
+        if workers is not None:
+            HASH_WORKERS = workers
+        if queue_size is not None:
+            HASH_QUEUE_SIZE = queue_size
+        if method is not None:
+            PASSWORD_HASH_METHOD = method
+        if _state['executor'] is not None and _state['pid'] == os.getpid():
+            _state['executor'].shutdown(wait=True)
+        _state.update(executor=None, pid=None, slots=None)
+
+
+def _pool():
+    # После fork пул родителя непригоден - создаем свой в каждом воркере
+    with _lock:
+        if _state['executor'] is None or _state['pid'] != os.getpid():
+            # multiprocessing импортируется при первом входе, а не при старте воркера
+            from concurrent.futures import ProcessPoolExecutor
+            _state['executor'] = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+            _state['pid'] = os.getpid()
+            _state['slots'] = threading.BoundedSemaphore(HASH_WORKERS + HASH_QUEUE_SIZE)
+        return _state['executor'], _state['slots']
+
+
+def _run(func, *args):
+    if HASH_WORKERS <= 0:
+        return func(*args)
+
+    executor, slots = _pool()
+    if not slots.acquire(blocking=False):
+        raise HashingBusy()
+    try:
+        future = executor.submit(func, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=HASH_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()
+        raise HashingBusy()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+
+@lru_cache(maxsize=None)
+def _stored_method(method):
+    """Префикс, с которым werkzeug сохраняет хэш: короткие имена
+    раскрываются ("scrypt" -> "scrypt:32768:8:1"), поэтому он берется
+    из хэша, созданного один раз на процесс, а не из настройки"""
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+def needs_rehash(password_hash):
+    """Хэш создан другим алгоритмом или с другой стоимостью, чем сейчас настроено"""
+    return password_hash.split('$', 1)[0] != _stored_method(PASSWORD_HASH_METHOD)
@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from flask import url_for
+from services.jobs import task, enqueue
+
+try:
+    import fcntl
+except ImportError:
+    # Нет flock (Windows): манифест защищен только от потоков своего процесса
+    fcntl = None
+
+# Папка с обложками (static/pic в корне проекта)
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER',
+                               os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                            'static', 'pic'))
+# Производные изображения лежат рядом, имена адресуются содержимым исходника
+RENDITIONS_DIR = os.path.join(UPLOAD_FOLDER, 'renditions')
+MANIFEST_PATH = os.path.join(RENDITIONS_DIR, 'manifest.json')
+MANIFEST_LOCK_PATH = os.path.join(RENDITIONS_DIR, 'manifest.lock')
+
+# Ширины вариантов: сетка каталога (1x/2x) и детальный просмотр
+RENDITION_WIDTHS = (320, 640, 960)
+# Форматы от предпочтительного к запасному; недоступные в Pillow пропускаются
+RENDITION_FORMATS = (('avif', 'AVIF', 'image/avif'), ('webp', 'WEBP', 'image/webp'),
+                     ('jpg', 'JPEG', 'image/jpeg'))
+RENDITION_QUALITY = {'AVIF': 55, 'WEBP': 75, 'JPEG': 80}
+GRID_SIZES = "(max-width: 640px) 100vw, 320px"
+
+logger = logging.getLogger(__name__)
+
+_manifest_lock = threading.Lock()
+_manifest = {'mtime': None, 'checked': float('-inf'), 'data': {}}
+
+
+def _pillow():
+    """Pillow - необязательная зависимость: без нее отдаются исходные обложки"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    return Image
+
+
+def _available_formats(Image):
+    Image.init()
+    saveable = set(Image.SAVE)
+    return [fmt for fmt in RENDITION_FORMATS if fmt[1] in saveable]
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:20]
+
+
+def _rendition_name(digest, width, ext):
+    return f"{digest}-{width}.{ext}"
+
+
+def load_manifest():
+    """Манифест {исходный файл: {hash, renditions}}; перечитывается при изменении
+    файла, но проверяет это не чаще раза в секунду"""
+    now = time.monotonic()
+    if now - _manifest['checked'] < 1.0:
+        return _manifest['data']
+    _manifest['checked'] = now
+    try:
+        mtime = os.stat(MANIFEST_PATH).st_mtime_ns
+    except OSError:
+        return {}
+    if _manifest['mtime'] != mtime:
+        try:
+            with open(MANIFEST_PATH, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return _manifest['data']
+        _manifest.update(mtime=mtime, data=data)
+    return _manifest['data']
+
+
+def _update_manifest(filename, entry):
+    """Чтение-изменение-запись манифеста. Задачи миниатюр выполняют
+    воркеры разных процессов, поэтому кроме блокировки потоков берется
+    flock на manifest.lock, а манифест читается с диска, минуя кэш."""
+    with _manifest_lock:
+        os.makedirs(RENDITIONS_DIR, exist_ok=True)
+        with open(MANIFEST_LOCK_PATH, 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(MANIFEST_PATH, encoding='utf-8') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {}
+            if entry is None:
+                data.pop(filename, None)
+            else:
+                data[filename] = entry
+            tmp_path = f"{MANIFEST_PATH}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(tmp_path, MANIFEST_PATH)
+            # flock снимается при закрытии файла блокировки
+        _manifest['checked'] = float('-inf')
+
+
+def generate_renditions(filename):
+    """Создает недостающие варианты обложки. Повторный вызов для того же
+    содержимого ничего не пересчитывает: имена зависят от хэша исходника."""
+    Image = _pillow()
+    source = os.path.join(UPLOAD_FOLDER, filename)
+    if Image is None or not os.path.isfile(source):
+        return None
+
+    os.makedirs(RENDITIONS_DIR, exist_ok=True)
+    digest = content_hash(source)
+    formats = _available_formats(Image)
+    renditions = {}
+
+    with Image.open(source) as original:
+        original = original.convert('RGB')
+        # Не увеличиваем маленькие исходники
+        widths = sorted({min(width, original.width) for width in RENDITION_WIDTHS})
+        for target_width in widths:
+            for ext, pil_format, mimetype in formats:
+                name = _rendition_name(digest, target_width, ext)
+                path = os.path.join(RENDITIONS_DIR, name)
+                if not os.path.exists(path):
+                    height = round(original.height * target_width / original.width)
+                    resized = original.resize((target_width, height), Image.LANCZOS)
+                    tmp_path = f"{path}.{os.getpid()}.tmp"
+                    resized.save(tmp_path, pil_format, quality=RENDITION_QUALITY[pil_format])
+                    os.replace(tmp_path, path)
+                renditions.setdefault(mimetype, []).append([name, target_width])
+
+    entry = {'hash': digest, 'renditions': renditions}
+    _update_manifest(filename, entry)
+    logger.info("Renditions ready for %s (%s)", filename, digest)
+    return entry
+
+
+def remove_renditions(filename):
+    """Удаляет варианты обложки и ее запись из манифеста. Файлы вариантов
+    остаются, если тот же исходник (тот же хэш) указан в другой записи."""
+    _manifest['checked'] = float('-inf')
+    entry = load_manifest().get(filename)
+    if not entry:
+        return 0
+    _update_manifest(filename, None)
+    if any(other.get('hash') == entry['hash'] for other in load_manifest().values()):
+        return 0
+    removed = 0
+    for items in entry['renditions'].values():
+        for name, _ in items:
+            try:
+                os.remove(os.path.join(RENDITIONS_DIR, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+@task('images.renditions')
+def renditions_task(filename):
+    generate_renditions(filename)
+
+
+def schedule_renditions(cur, filename):
+    """Ставит построение вариантов в очередь задач в транзакции записи
+    книги: запрос не ждет Pillow, а сбой воркера не теряет задачу"""
+    if _pillow() is None:
+        return
+    enqueue(cur, 'images.renditions', {'filename': filename}, key=f"renditions:{filename}")
+
+
+def backfill(progress=None):
+    """Строит варианты для всех уже загруженных обложек"""
+    done = 0
+    for name in sorted(os.listdir(UPLOAD_FOLDER)):
+        if os.path.isfile(os.path.join(UPLOAD_FOLDER, name)) and not name.startswith('.'):
+            try:
+                generate_renditions(name)
+            except Exception:
+                logger.exception("Failed to build renditions for %s", name)
+                continue
+            done += 1
+            if progress:
+                progress(name, done)
+    return done
+
+
+def cover_sources(filename):
+    """Для шаблонов: [(mimetype, srcset), ...] от лучшего формата к JPEG.
+    Пустой список, если варианты еще не построены."""
+    entry = load_manifest().get(filename or 'default_cover.jpg')
+    if not entry:
+        return []
+    sources = []
+    for _, _, mimetype in RENDITION_FORMATS:
+        items = entry['renditions'].get(mimetype)
+        if items:
+            srcset = ', '.join(f"{url_for('static', filename='pic/renditions/' + name)} {width}w"
+                               for name, width in items)
+            sources.append((mimetype, srcset))
+    return sources
+
+
+def init_app(app):
+    app.jinja_env.globals.update(cover_sources=cover_sources, cover_sizes=GRID_SIZES)
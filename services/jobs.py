@@ -0,0 +1,292 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+import click
+from flask.cli import AppGroup
+from db.database import db_connect, db_close
+
+# Где выполняются задачи: thread - фоновый поток в каждом веб-процессе,
+# external - только отдельный процесс `flask jobs work`
+JOB_WORKER = os.environ.get('JOB_WORKER', 'thread')
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+# Задача, взятая воркером, считается брошенной (процесс упал) через столько секунд
+JOB_LEASE = float(os.environ.get('JOB_LEASE', 300))
+# Пауза перед повтором: JOB_RETRY_DELAY * 2^(попытка - 1)
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', 10))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2.0))
+# Выполненные задачи хранятся для просмотра столько секунд
+JOB_KEEP_DONE = float(os.environ.get('JOB_KEEP_DONE', 7 * 24 * 3600))
+
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+logger = logging.getLogger(__name__)
+
+TASKS = {}
+
+_wake = threading.Event()
+_worker = {'pid': None, 'thread': None}
+_worker_lock = threading.Lock()
+
+
+def task(name):
+    """Регистрирует функцию задачи. Задача должна быть идемпотентной:
+    при сбое воркера она может выполниться повторно (at-least-once)."""
+    def decorator(func):
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+def enqueue(cur, name, payload=None, key=None, delay=0, max_attempts=JOB_MAX_ATTEMPTS):
+    """Ставит задачу в очередь в текущей транзакции: задача появится
+    вместе с изменением книги и только если оно зафиксировано.
+    Если задача с тем же key еще ждет, новая не добавляется."""
+    if name not in TASKS:
+        raise KeyError(f"Неизвестная задача: {name}")
+    now = time.time()
+    cur.execute(
+        "INSERT OR IGNORE INTO jobs (task, payload, key, max_attempts, run_at, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (name, json.dumps(payload or {}, ensure_ascii=False), key, max_attempts, now + delay, now, now)
+    )
+    _wake_after_commit(cur)
+
+
+def has_ready(cur):
+    """Есть ли работа; проверяется на соединении чтения, чтобы простаивающий
+    воркер не занимал очередь писателей"""
+    now = time.time()
+    cur.execute("SELECT 1 FROM jobs WHERE (status = 'queued' AND run_at <= ?) "
+                "OR (status = 'running' AND locked_until < ?) LIMIT 1", (now, now))
+    return cur.fetchone() is not None
+
+
+def claim(cur, lease=JOB_LEASE):
+    """Берет одну готовую задачу (или брошенную упавшим воркером).
+    Возвращает строку задачи или None."""
+    now = time.time()
+    cur.execute(
+        "UPDATE jobs SET status = 'failed', locked_until = NULL, updated_at = ?, "
+        "last_error = coalesce(last_error, 'воркер не завершил задачу') "
+        "WHERE status = 'running' AND locked_until < ? AND attempts >= max_attempts",
+        (now, now)
+    )
+    cur.execute(
+        """UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = ?
+           WHERE id = (SELECT id FROM jobs
+                       WHERE (status = 'queued' AND run_at <= ?)
+                          OR (status = 'running' AND locked_until < ?)
+                       ORDER BY run_at, id LIMIT 1)
+           RETURNING id, task, payload, attempts, max_attempts""",
+        (now + lease, now, now, now)
+    )
+    # RETURNING: строки нужно дочитать до фиксации транзакции
+    rows = cur.fetchall()
+    return rows[0] if rows else None
+
+
+def complete(cur, job_id):
+    cur.execute("UPDATE jobs SET status = 'done', locked_until = NULL, last_error = NULL, updated_at = ? "
+                "WHERE id = ?", (time.time(), job_id))
+
+
+def fail(cur, job, error):
+    """Ошибка задачи: повтор с экспоненциальной паузой или failed после
+    последней попытки"""
+    now = time.time()
+    if job['attempts'] >= job['max_attempts']:
+        cur.execute("UPDATE jobs SET status = 'failed', locked_until = NULL, last_error = ?, updated_at = ? "
+                    "WHERE id = ?", (error, now, job['id']))
+    else:
+        retry_at = now + JOB_RETRY_DELAY * 2 ** (job['attempts'] - 1)
+        cur.execute("UPDATE jobs SET status = 'queued', locked_until = NULL, last_error = ?, run_at = ?, "
+                    "updated_at = ? WHERE id = ?", (error, retry_at, now, job['id']))
+
+
+def run_one():
+    """Выполняет одну задачу. False, если выполнять нечего.
+    Соединение записи держится только на время взятия и отметки задачи."""
+    conn, cur = db_connect(readonly=True)
+    try:
+        ready = has_ready(cur)
+    finally:
+        db_close(conn, cur)
+    if not ready:
+        return False
+
+    conn, cur = db_connect()
+    try:
+        job = claim(cur)
+    finally:
+        db_close(conn, cur)
+    if job is None:
+        return False
+
+    error = None
+    func = TASKS.get(job['task'])
+    if func is None:
+        error = f"Неизвестная задача: {job['task']}"
+    else:
+        started = time.perf_counter()
+        try:
+            func(**json.loads(job['payload']))
+        except Exception as e:
+            logger.exception("job failed id=%s task=%s attempt=%s", job['id'], job['task'], job['attempts'])
+            error = f"{type(e).__name__}: {e}"
+        else:
+            logger.debug("job done id=%s task=%s ms=%.1f", job['id'], job['task'],
+                         (time.perf_counter() - started) * 1000)
+
+    conn, cur = db_connect()
+    try:
+        if error is None:
+            complete(cur, job['id'])
+        else:
+            fail(cur, job, error)
+    finally:
+        db_close(conn, cur)
+    return True
+
+
+def prune(cur, older_than=JOB_KEEP_DONE):
+    cur.execute("DELETE FROM jobs WHERE status = 'done' AND updated_at < ?", (time.time() - older_than,))
+    return cur.rowcount
+
+
+def work(stop=None, once=False, poll=JOB_POLL_INTERVAL):
+    """Цикл воркера: выполняет задачи, пока есть готовые, затем ждет
+    постановки новой задачи (в этом процессе) или poll секунд"""
+    stop = stop or threading.Event()
+    done = 0
+    last_prune = 0.0
+    while not stop.is_set():
+        try:
+            if run_one():
+                done += 1
+                continue
+            if time.monotonic() - last_prune > 3600:
+                conn, cur = db_connect()
+                prune(cur)
+                db_close(conn, cur)
+                last_prune = time.monotonic()
+        except Exception:
+            # База занята или недоступна - пробуем позже, воркер не падает
+            logger.exception("job worker error")
+        if once:
+            break
+        _wake.wait(poll)
+        _wake.clear()
+    return done
+
+
+def wake():
+    _wake.set()
+    ensure_worker()
+
+
+def _wake_after_commit(cur):
+    """Воркер будится только после фиксации: раньше он не увидит задачу
+    и уснет до следующего опроса. Соединения вне пула (массовая загрузка)
+    хуков не поддерживают - их задачи подхватит опрос очереди."""
+    after_commit = getattr(cur.connection, 'after_commit', None)
+    if after_commit is not None:
+        after_commit(wake)
+
+
+def ensure_worker():
+    """Запускает фоновый поток-воркер в текущем процессе (JOB_WORKER=thread).
+    Поток создается лениво, уже после fork воркера gunicorn."""
+    if JOB_WORKER != 'thread' or _worker['pid'] == os.getpid():
+        return
+    with _worker_lock:
+        if _worker['pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=work, name='jobs', daemon=True)
+        thread.start()
+        _worker.update(pid=os.getpid(), thread=thread)
+
+
+def summary(cur):
+    """Число задач по статусам"""
+    cur.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update((row[0], row[1]) for row in cur.fetchall())
+    return counts
+
+
+def recent(cur, status=None, limit=50):
+    if status:
+        cur.execute("SELECT * FROM jobs WHERE status = ? ORDER BY updated_at DESC LIMIT ?", (status, limit))
+    else:
+        cur.execute("SELECT * FROM jobs ORDER BY updated_at DESC LIMIT ?", (limit,))
+    return cur.fetchall()
+
+
+def retry(cur, job_id):
+    """Возвращает упавшую задачу в очередь с новым запасом попыток"""
+    now = time.time()
+    cur.execute("UPDATE OR IGNORE jobs SET status = 'queued', attempts = 0, run_at = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'failed'", (now, now, job_id))
+    if cur.rowcount:
+        _wake_after_commit(cur)
+    return cur.rowcount
+
+
+jobs_cli = AppGroup('jobs', help='Очередь фоновых задач')
+
+
+@jobs_cli.command('work')
+@click.option('--once', is_flag=True, help='Выполнить готовые задачи и выйти')
+@click.option('--poll', type=float, default=JOB_POLL_INTERVAL, show_default=True,
+              help='Как часто проверять очередь, секунды')
+def work_command(once, poll):
+    """Воркер очереди задач (для JOB_WORKER=external)"""
+    if once:
+        done = 0
+        while run_one():
+            done += 1
+    else:
+        click.echo("Воркер запущен, Ctrl+C - остановка", err=True)
+        try:
+            done = work(poll=poll)
+        except KeyboardInterrupt:
+            done = None
+    if done is not None:
+        click.echo(f"Выполнено задач: {done}", err=True)
+
+
+@jobs_cli.command('status')
+@click.option('--failed', is_flag=True, help='Показать упавшие задачи')
+def status_command(failed):
+    """Состояние очереди"""
+    conn, cur = db_connect(readonly=True)
+    counts = summary(cur)
+    rows = recent(cur, 'failed') if failed else []
+    db_close(conn, cur)
+    click.echo('  '.join(f"{name}: {count}" for name, count in counts.items()))
+    for row in rows:
+        click.echo(f"#{row['id']} {row['task']} {row['payload']} попыток {row['attempts']}: {row['last_error']}")
+
+
+@jobs_cli.command('retry')
+@click.argument('job_ids', type=int, nargs=-1, required=True)
+def retry_command(job_ids):
+    """Повторить упавшие задачи"""
+    conn, cur = db_connect()
+    requeued = sum(retry(cur, job_id) for job_id in job_ids)
+    db_close(conn, cur)
+    click.echo(f"Возвращено в очередь: {requeued}", err=True)
+
+
+def format_timestamp(value):
+    return datetime.fromtimestamp(value).strftime('%d.%m.%Y %H:%M:%S') if value else ''
+
+
+def init_app(app):
+    app.cli.add_command(jobs_cli)
+    app.jinja_env.filters['timestamp'] = format_timestamp
+    # Задачи, поставленные до перезапуска, подхватываются с первым запросом
+    app.before_request(ensure_worker)
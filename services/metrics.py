@@ -0,0 +1,378 @@
+import glob
+import hmac
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from flask import g, request, session, has_request_context, before_render_template, template_rendered, Response, abort
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Сколько разных текстов запросов хранить в агрегатах
+MAX_STATEMENTS = 200
+
+# Профилировщик по запросу: ?_profile=1 для администратора или всем при PROFILING_ENABLED=1
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED') == '1'
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.001))
+
+# /metrics доступен администратору или с заголовком Authorization: Bearer <METRICS_TOKEN>
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+# Метрики считает каждый процесс отдельно. Если задан METRICS_DIR, воркеры
+# сбрасывают туда свои снимки (не чаще раза в METRICS_FLUSH_INTERVAL секунд),
+# а /metrics отдает сумму по всем файлам - любой воркер отвечает за всех.
+# Без METRICS_DIR ответ содержит счетчики только ответившего воркера.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1.0))
+
+logger = logging.getLogger(__name__)
+sql_logger = logging.getLogger('sql')
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+# Метрики процесса (у каждого воркера свои)
+_lock = threading.Lock()
+_request_latency = defaultdict(Histogram)        # route -> Histogram
+_phase_seconds = defaultdict(float)              # (route, phase) -> секунды
+_responses = Counter()                           # (route, status) -> количество
+_statements = {}                                 # текст -> [количество, секунды, строки]
+_counters = Counter()                            # (имя, метки) -> значение, см. count()
+_flushed = {'at': 0.0}
+_flush_lock = threading.Lock()
+
+
+def _normalize_sql(sql):
+    return ' '.join(sql.split())
+
+
+def _record_statement(sql, duration, rows, call=True):
+    text = _normalize_sql(sql)
+    with _lock:
+        entry = _statements.get(text)
+        if entry is None and len(_statements) < MAX_STATEMENTS:
+            entry = _statements[text] = [0, 0.0, 0]
+        if entry is not None:
+            entry[0] += call
+            entry[1] += duration
+            entry[2] += rows
+    if has_request_context() and 'request_timing' in g:
+        timing = g.request_timing
+        timing['db'] += duration
+        timing['queries'] += call
+    if call and sql_logger.isEnabledFor(logging.DEBUG):
+        sql_logger.debug("sql duration_ms=%.3f rows=%d statement=%s", duration * 1000, rows, text)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Курсор, который замеряет время выполнения и число строк каждого запроса.
+    Время выборки (fetch*) добавляется к последнему выполненному запросу."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._last_sql = sql
+            duration = time.perf_counter() - start
+            rows = self.rowcount if self.rowcount > 0 else 0
+            _record_statement(sql, duration, rows)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._last_sql = sql
+            _record_statement(sql, time.perf_counter() - start, max(self.rowcount, 0))
+
+    def _fetched(self, start, rows):
+        sql = getattr(self, '_last_sql', None)
+        if sql is not None:
+            _record_statement(sql, time.perf_counter() - start, rows, call=False)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+
+def count(name, value=1, **labels):
+    """Счетчик других модулей (например, попадания в кэш страниц), попадает
+    в /metrics как <name>{метки} с типом counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += value
+
+
+@contextmanager
+def timed(phase):
+    """Учитывает время блока в разбивке запроса (например, 'file_io')"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and 'request_timing' in g:
+            g.request_timing[phase] = g.request_timing.get(phase, 0.0) + time.perf_counter() - start
+
+
+class SamplingProfiler:
+    """Семплирующий профилировщик одного потока: раз в interval снимает стек
+    и считает одинаковые стеки (формат collapsed stacks для flamegraph)."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def report(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def _profiling_requested():
+    return request.args.get('_profile') == '1' and (PROFILING_ENABLED or session.get('is_admin'))
+
+
+def _before_request():
+    g.request_timing = {'start': time.perf_counter(), 'db': 0.0, 'template': 0.0, 'queries': 0}
+    if _profiling_requested():
+        g.profiler = SamplingProfiler(threading.get_ident())
+        g.profiler.start()
+
+
+def _before_render(sender, template, context, **extra):
+    if 'request_timing' in g:
+        g.request_timing['template_start'] = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    timing = g.get('request_timing')
+    if timing and 'template_start' in timing:
+        timing['template'] += time.perf_counter() - timing.pop('template_start')
+
+
+def _after_request(response):
+    timing = g.get('request_timing')
+    if timing is None:
+        return response
+    total = time.perf_counter() - timing['start']
+    route = request.endpoint or 'unknown'
+    phases = {name: value for name, value in timing.items()
+              if name not in ('start', 'queries') and isinstance(value, float)}
+
+    with _lock:
+        _request_latency[route].observe(total)
+        _responses[(route, response.status_code)] += 1
+        for phase, value in phases.items():
+            _phase_seconds[(route, phase)] += value
+    if METRICS_DIR and time.monotonic() - _flushed['at'] > METRICS_FLUSH_INTERVAL:
+        _flush_quietly()
+
+    response.headers['Server-Timing'] = ', '.join(
+        [f"{phase};dur={value * 1000:.2f}" for phase, value in phases.items()]
+        + [f"total;dur={total * 1000:.2f}"]
+    )
+    logger.debug("request route=%s status=%s total_ms=%.2f db_ms=%.2f queries=%d template_ms=%.2f",
+                 route, response.status_code, total * 1000, timing['db'] * 1000,
+                 timing['queries'], timing['template'] * 1000)
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.stop()
+        return Response(profiler.report(), mimetype='text/plain')
+    return response
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def snapshot():
+    """Счетчики процесса в виде, пригодном для JSON и сложения"""
+    with _lock:
+        return {
+            'latency': {route: [hist.buckets, hist.count, hist.sum] for route, hist in _request_latency.items()},
+            'responses': [[route, status, count] for (route, status), count in _responses.items()],
+            'phases': [[route, phase, value] for (route, phase), value in _phase_seconds.items()],
+            'statements': {text: list(entry) for text, entry in _statements.items()},
+            'counters': [[name, dict(labels), value] for (name, labels), value in _counters.items()],
+        }
+
+
+def write_snapshot():
+    """Сбрасывает снимок процесса в METRICS_DIR/<pid>.json. Файлы завершившихся
+    воркеров остаются: их счетчики входят в сумму до перезапуска сервера.
+    Потоки воркера пишут по очереди, каждый через свой временный файл."""
+    with _flush_lock:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{os.getpid()}-", suffix='.tmp', dir=METRICS_DIR)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(snapshot(), f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        _flushed['at'] = time.monotonic()
+
+
+def _flush_quietly():
+    # Сбой записи метрик не должен превращать ответ или сбор метрик в 500
+    try:
+        write_snapshot()
+    except OSError:
+        logger.exception("metrics snapshot write failed dir=%s", METRICS_DIR)
+
+
+def merged_snapshot(include_self=True):
+    """Сумма снимков всех воркеров из METRICS_DIR. include_self=False -
+    для команд CLI: их собственные (пустые) счетчики не записываются."""
+    if include_self:
+        _flush_quietly()
+    total = {'latency': {}, 'responses': Counter(), 'phases': defaultdict(float), 'statements': {},
+             'counters': Counter()}
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for route, (buckets, count, seconds) in data['latency'].items():
+            entry = total['latency'].setdefault(route, [[0] * len(buckets), 0, 0.0])
+            entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+            entry[1] += count
+            entry[2] += seconds
+        for route, status, count in data['responses']:
+            total['responses'][(route, status)] += count
+        for route, phase, value in data['phases']:
+            total['phases'][(route, phase)] += value
+        for text, values in data['statements'].items():
+            entry = total['statements'].setdefault(text, [0, 0.0, 0])
+            for i, value in enumerate(values):
+                entry[i] += value
+        for name, labels, value in data.get('counters', ()):
+            total['counters'][(name, tuple(sorted(labels.items())))] += value
+    total['responses'] = [[route, status, count] for (route, status), count in total['responses'].items()]
+    total['phases'] = [[route, phase, value] for (route, phase), value in total['phases'].items()]
+    total['counters'] = [[name, dict(labels), value] for (name, labels), value in total['counters'].items()]
+    return total
+
+
+def render_metrics(data=None):
+    """Метрики в текстовом формате Prometheus (по умолчанию - этого процесса)"""
+    data = data or snapshot()
+    lines = [
+        '# HELP http_request_duration_seconds Request latency by route.',
+        '# TYPE http_request_duration_seconds histogram',
+    ]
+    for route, (buckets, count, seconds) in sorted(data['latency'].items()):
+        for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+            lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="{bound}"}} {bucket}')
+        lines.append(f'http_request_duration_seconds_bucket{{route="{route}",le="+Inf"}} {count}')
+        lines.append(f'http_request_duration_seconds_sum{{route="{route}"}} {seconds:.6f}')
+        lines.append(f'http_request_duration_seconds_count{{route="{route}"}} {count}')
+
+    lines += ['# HELP http_responses_total Responses by route and status.',
+              '# TYPE http_responses_total counter']
+    for route, status, count in sorted(data['responses']):
+        lines.append(f'http_responses_total{{route="{route}",status="{status}"}} {count}')
+
+    lines += ['# HELP http_request_phase_seconds_total Time spent per request phase (db, template, file_io).',
+              '# TYPE http_request_phase_seconds_total counter']
+    for route, phase, value in sorted(data['phases']):
+        lines.append(f'http_request_phase_seconds_total{{route="{route}",phase="{phase}"}} {value:.6f}')
+
+    lines += ['# HELP sqlite_statement_seconds_total Time spent per SQL statement text.',
+              '# TYPE sqlite_statement_seconds_total counter']
+    for text, (count, seconds, rows) in sorted(data['statements'].items(), key=lambda item: -item[1][1]):
+        label = _label(text[:200])
+        lines.append(f'sqlite_statement_seconds_total{{statement="{label}"}} {seconds:.6f}')
+        lines.append(f'sqlite_statement_calls_total{{statement="{label}"}} {count}')
+        lines.append(f'sqlite_statement_rows_total{{statement="{label}"}} {rows}')
+
+    declared = set()
+    for name, labels, value in sorted(data['counters'], key=lambda item: (item[0], sorted(item[1].items()))):
+        if name not in declared:
+            lines.append(f'# TYPE {name} counter')
+            declared.add(name)
+        label_text = ','.join(f'{key}="{_label(label)}"' for key, label in sorted(labels.items()))
+        lines.append(f'{name}{{{label_text}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics_allowed():
+    if session.get('is_admin'):
+        return True
+    if not METRICS_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}")
+
+
+def metrics_view():
+    if not _metrics_allowed():
+        abort(403)
+    data = merged_snapshot() if METRICS_DIR else None
+    return Response(render_metrics(data), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    from db.database import PooledConnection
+    PooledConnection.cursor_class = InstrumentedCursor
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,176 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session, make_response
+from markupsafe import Markup
+from db.database import db_connect
+from db.catalog import catalog_generation, filters_from_args
+from services.metrics import count
+
+# Параметры каталога, от которых зависит страница; остальные игнорируются
+PAGE_PARAMS = ('q', 'title', 'author', 'publisher', 'pages_min', 'pages_max',
+               'sort_field', 'sort_order', 'page', 'after', 'before')
+
+PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL', 300))
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 8192))
+
+# Грубая оценка размера строки книги для бюджета памяти фрагментов
+ROW_SIZE_ESTIMATE = 512
+
+# Счетчик обращений к кэшу в /metrics: cache - вид записи, result - hit/miss
+CACHE_METRIC = 'app_cache_requests_total'
+
+
+class LRUCache:
+    """LRU-кэш с TTL и ограничением по суммарному размеру значений.
+    Каждая запись привязана к поколению каталога: запись другого
+    поколения считается промахом и удаляется."""
+
+    def __init__(self, max_bytes, max_entries, ttl):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (generation, expires, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_generation, expires, size, value = entry
+            if entry_generation != generation or expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, generation, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (generation, time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_cache = LRUCache(PAGE_CACHE_MAX_BYTES, PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_TTL)
+
+
+def _lookup(kind, key, generation):
+    value = _cache.get(key, generation)
+    count(CACHE_METRIC, cache=kind, result='miss' if value is None else 'hit')
+    return value
+
+
+def normalized_args(args):
+    """Ключ из параметров запроса: только значимые, без пустых, в фиксированном порядке.
+    Фильтры берутся ровно в том виде, в каком они попадают в запрос
+    (filters_from_args): иначе, например, "author=Кинг " и "author=Кинг"
+    делили бы одну запись кэша при разных результатах."""
+    filters = filters_from_args(args)
+    items = []
+    for name in PAGE_PARAMS:
+        value = filters[name] if name in filters else args.get(name, '')
+        if value and not (name == 'page' and value == '1'):
+            items.append((name, value))
+    return tuple(items)
+
+
+def is_admin():
+    return bool(session.get('is_admin'))
+
+
+def is_anonymous():
+    """Страницу целиком можно кэшировать только для гостя без flash-сообщений:
+    иначе в разметке есть имя пользователя или разовые уведомления"""
+    return not session.get('username') and not session.get('_flashes')
+
+
+def _etag(endpoint, key, generation):
+    raw = repr((endpoint, key, generation)).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()
+
+
+def cached_page(view):
+    """Кэширует ответ представления для гостей по нормализованным параметрам.
+
+    Поколение каталога входит в ключ и ETag, поэтому любая запись
+    в books сразу делает старые страницы недействительными."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_anonymous():
+            return view(*args, **kwargs)
+
+        conn, cur = db_connect(readonly=True)
+        generation = catalog_generation(cur)
+        key = ('page', request.endpoint, normalized_args(request.args))
+
+        entry = _lookup('page', key, generation)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            entry = (body, response.mimetype, time.time())
+            _cache.set(key, generation, entry, len(body))
+
+        body, mimetype, created = entry
+        response = make_response(body)
+        response.mimetype = mimetype
+        response.set_etag(_etag(request.endpoint, key, generation))
+        response.last_modified = created
+        # Браузер хранит страницу, но перепроверяет ее (получая 304)
+        response.cache_control.public = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    return wrapper
+
+
+def cached_fragment(name, generation, compute, size):
+    """Кэш данных для фрагмента страницы (результаты запросов), общий для
+    всех пользователей, кроме администратора. compute() вызывается при промахе,
+    size(value) оценивает занимаемую значением память в байтах."""
+    if is_admin():
+        return compute()
+    key = ('fragment', name, normalized_args(request.args))
+    value = _lookup('fragment', key, generation)
+    if value is None:
+        value = compute()
+        _cache.set(key, generation, value, size(value))
+    return value
+
+
+def cached_html(key, generation, render):
+    """Кэш готовой разметки фрагмента (карточка книги, список фасета).
+    Ключ не зависит от параметров запроса: все, что влияет на разметку,
+    должно входить в key. render() вызывается при промахе."""
+    kind = key[0]
+    key = ('html',) + tuple(key)
+    html = _lookup(kind, key, generation)
+    if html is None:
+        html = Markup(render())
+        _cache.set(key, generation, html, len(html) * 2)
+    return html
@@ -0,0 +1,8 @@
+"""Точка входа WSGI для продакшен-сервера:
+
+    flask --app app init-db              # один раз: схема и миграции
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app
+
+app = create_app()